@@ -1,131 +1,755 @@
 #!/usr/bin/env python3
-import copy
+# asyncio, json, pickle and traceback are imported where they are used, they dominate the import time
+import os
+import struct
 import time
-from vb_utils_ros.utils import LockedVariable
-from threading import Thread
+import zlib
+from time import perf_counter, perf_counter_ns
+from bisect import bisect_left
+from heapq import heapify, heappop, heappush
+from collections import OrderedDict, namedtuple
+from itertools import count
+from operator import contains, eq, ge, gt, le, lt, ne
+from enum import IntEnum
+from queue import Full, Queue
+from threading import Condition, Lock, RLock, Thread
+from types import MappingProxyType
+from weakref import WeakValueDictionary, ref
 
 
-class PassingData(set):  # FIXME
-    def __init__(self):
-        _data = {}
-        _locks = {}
+class LockedVariable(object):
+    # single value behind a lock, this module used to take it from vb_utils_ros
+    __slots__ = ("_value", "_lock")
+
+    def __init__(self, value=None):
+        self._value = value
+        self._lock = Lock()
+
+    def store(self, value):
+        with self._lock:
+            self._value = value
+
+    def retr(self):
+        with self._lock:
+            return self._value
+
+
+class PassingData(object):
+    # values are stored and returned by reference, so reads and snapshots never need to copy them.
+    # they must be treated as immutable: a list or dict changed in place is seen by every reader but
+    # bumps no version and takes no lock. change a value by replacing it, with set() or with update()
+    # and a function returning a new value (copy-on-write); NumPy arrays are stored read-only to enforce it
+    __slots__ = ("_data", "_versions", "_locks", "_lock")
+
+    def __init__(self, **values):
+        object.__setattr__(self, "_data", {})
+        object.__setattr__(self, "_versions", {})
+        object.__setattr__(self, "_locks", {})
+        object.__setattr__(self, "_lock", Lock())
+        for name, value in values.items():
+            self.set(name, value)
 
     def __getattr__(self, name):
+        # private names are slots, one missing means the instance is not initialised yet (copy, pickle)
         if name[0] == "_":
-            return set.__getattr__(self, name)
-        else:
+            raise AttributeError(name)
+        try:
             return self._data[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getstate__(self):
+        with self._lock:
+            return dict(self._data), dict(self._versions)
+
+    def __setstate__(self, state):
+        # locks cannot be copied or pickled, the copy gets its own
+        data, versions = state
+        object.__setattr__(self, "_data", dict((name, _shared(value)) for name, value in data.items()))
+        object.__setattr__(self, "_versions", versions)
+        object.__setattr__(self, "_locks", {})
+        object.__setattr__(self, "_lock", Lock())
 
     def __setattr__(self, name, value):
         if name[0] == "_":
-            set.__setattr__(self, name, value)
+            object.__setattr__(self, name, value)
+        else:
+            self.set(name, value)
+
+    def __contains__(self, name):
+        return name in self._data
+
+    def get(self, name, default=None):
+        return self._data.get(name, default)
+
+    def set(self, name, value):
+        value = _shared(value)
+        with self.lock(name), self._lock:
+            self._data[name] = value
+            self._versions[name] = self._versions.get(name, 0) + 1
+
+    def update(self, name, function):
+        with self.lock(name):
+            self.set(name, function(self._data.get(name)))
+            return self._data[name]
+
+    def lock(self, name):
+        lock = self._locks.get(name)
+        if lock is None:
+            with self._lock:
+                lock = self._locks.setdefault(name, RLock())
+        return lock
+
+    def view(self, name):
+        return memoryview(self._data[name]).toreadonly()
+
+    def version(self, name):
+        return self._versions.get(name, 0)
+
+    def changed(self, name, version):
+        return self._versions.get(name, 0) != version
+
+    def keys(self):
+        return list(self._data)
+
+    def snapshot(self):
+        with self._lock:
+            return MappingProxyType(dict(self._data)), dict(self._versions)
+
+
+def _shared(value):
+    flags = getattr(value, "flags", None)
+    if hasattr(value, "__array_interface__") and getattr(flags, "writeable", False):
+        # zero-copy read-only view, states cannot write through the shared array
+        value = value.view()
+        value.flags.writeable = False
+    return value
+
+
+class Phase(IntEnum):
+    IDLE = 0
+    BEGINNING = 1
+    EXECUTING = 2
+    ENDING = 3
+
+
+# flag bits of the lifecycle state word, see AbstractState.status()
+PAUSED = 0x1
+PREEMPTED = 0x2
+ABORTED = 0x4
+TIMED_OUT = 0x8
+_STOPPED = PREEMPTED | ABORTED | TIMED_OUT
+
+_UNROUTED = object()
+
+StateStatus = namedtuple("StateStatus", ["phase", "paused", "preempted", "aborted"])
+
+
+class FixedIdle(object):
+    def __init__(self, period=0.1):
+        self.period = period
+
+    def next_timeout(self, previous):
+        return self.period
+
+
+class BackoffIdle(object):
+    def __init__(self, initial=0.001, maximum=0.1, factor=2.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+
+    def next_timeout(self, previous):
+        if previous is None:
+            return self.initial
+        return min(previous * self.factor, self.maximum)
+
+
+class BlockingIdle(object):
+    # idle is called once per pause, then the state sleeps until resumed or stopped
+    def next_timeout(self, previous):
+        return None
+
+
+_default_idle_strategy = FixedIdle()
+
+
+class Rate(object):
+    # paces execute() on absolute deadlines so that the period does not drift
+    _policies = ("sleep", "spin", "hybrid")
+    spin_margin = 0.001
+
+    def __init__(self, hz, policy="sleep", on_overrun=None):
+        if policy not in self._policies:
+            raise ValueError("unknown rate policy %s" % policy)
+        self.period = 1.0 / hz
+        self.policy = policy
+        self.on_overrun = on_overrun
+        self.overruns = 0
+        self.last_lateness = 0.0
+        self.deadline = None
+
+    def reset(self):
+        self.deadline = perf_counter()
+
+    def advance(self, state):
+        # moves to the next deadline and returns the time left until it, None when already late
+        self.deadline += self.period
+        now = perf_counter()
+        if now > self.deadline:
+            # late: report it and re-anchor instead of bursting to catch up
+            self.overruns += 1
+            self.last_lateness = now - self.deadline
+            self.deadline = now
+            if self.on_overrun is not None:
+                self.on_overrun(state, self.last_lateness)
+            return None
+        return self.deadline - now
+
+    def sleep(self, state):
+        remaining = self.advance(state)
+        if remaining is None:
+            return False
+        if self.policy == "sleep":
+            state._wait_flagged(remaining)
         else:
-            self._data[name] = copy.copy(value)
+            if self.policy == "hybrid" and remaining > self.spin_margin:
+                if state._wait_flagged(remaining - self.spin_margin):
+                    return True
+            while perf_counter() < self.deadline and not state._get_flags_locked():
+                pass
+        return True
+
+
+class TimerScheduler(object):
+    # one heap and one thread serve every timeout of the process, cancelled entries are dropped lazily
+    def __init__(self):
+        self._heap = []
+        self._sequence = count()
+        self._cancelled = 0
+        self._changed = Condition()
+        self._thread = None
+
+    def schedule(self, when, callback):
+        # when is a time.monotonic() value, callback receives the entry returned here
+        entry = [when, next(self._sequence), callback]
+        with self._changed:
+            heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = Thread(target=self._work, name="state_machine_timers", daemon=True)
+                self._thread.start()
+            if self._heap[0] is entry:
+                self._changed.notify()
+        return entry
+
+    def cancel(self, entry):
+        with self._changed:
+            if entry[2] is None:
+                return
+            entry[2] = None
+            self._cancelled += 1
+            if self._cancelled > len(self._heap) // 2:
+                self._heap = [entry for entry in self._heap if entry[2] is not None]
+                heapify(self._heap)
+                self._cancelled = 0
+
+    def __len__(self):
+        with self._changed:
+            return len(self._heap) - self._cancelled
+
+    def _next(self):
+        while True:
+            while self._heap and self._heap[0][2] is None:
+                heappop(self._heap)
+                self._cancelled -= 1
+            if not self._heap:
+                self._changed.wait()
+                continue
+            delay = self._heap[0][0] - time.monotonic()
+            if delay > 0:
+                self._changed.wait(delay)
+                continue
+            entry = heappop(self._heap)
+            callback, entry[2] = entry[2], None
+            return callback, entry
+
+    def _work(self):
+        while True:
+            with self._changed:
+                callback, entry = self._next()
+            try:
+                callback(entry)
+            except Exception:
+                import traceback
+
+                traceback.print_exc()
+
+
+_default_scheduler = None
+_default_scheduler_lock = Lock()
+
+
+def default_scheduler():
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = TimerScheduler()
+        return _default_scheduler
+
+
+def _stopped_outcome(flags):
+    if flags & ABORTED:
+        return "__aborted__"
+    if flags & PREEMPTED:
+        return "__preempted__"
+    return "__timeout__"
+
+
+class StateRegistry(object):
+    # holds weak references only, states disappear from it once garbage collected
+    def __init__(self):
+        self._states = WeakValueDictionary()
+        self._lock = Lock()
+
+    def add(self, state):
+        with self._lock:
+            self._states[id(state)] = state
+
+    def get(self, state_id):
+        return self._states.get(state_id)
+
+    def find(self, name):
+        return [state for state in self if state.name == name]
+
+    def __iter__(self):
+        with self._lock:
+            states = list(self._states.values())
+        return iter(states)
+
+    def __len__(self):
+        return len(self._states)
+
+
+class CancelToken(object):
+    # shared by a state machine and every state below it: preempt and abort of the owner are one
+    # write seen by all levels. each state keeps its own condition, cancel() wakes the running states only
+    __slots__ = ("owner", "flags", "_lock", "_members", "_watchers")
+
+    def __init__(self, owner):
+        self.owner = ref(owner)
+        self.flags = 0
+        self._lock = Lock()
+        self._members = set()
+        self._watchers = []
+
+    def cancel(self, flag):
+        with self._lock:
+            self.flags |= flag
+            members = list(self._members)
+            watchers = list(self._watchers)
+        for changed in members:
+            with changed:
+                changed.notify_all()
+        # states that do not block on a condition (other processes, event loops) are told directly
+        for watcher in watchers:
+            watcher(flag)
+
+    def clear(self):
+        with self._lock:
+            self.flags = 0
+
+    def join(self, changed):
+        with self._lock:
+            self._members.add(changed)
+
+    def leave(self, changed):
+        with self._lock:
+            self._members.discard(changed)
+
+    def watch(self, watcher):
+        with self._lock:
+            self._watchers.append(watcher)
+
+    def unwatch(self, watcher):
+        with self._lock:
+            self._watchers.remove(watcher)
 
 
 class AbstractState(object):
-    _states = []
+    __slots__ = (
+        "name",
+        "outcomes",
+        "idle_strategy",
+        "rate",
+        "timeout",
+        "watchdog",
+        "_deadline",
+        "_kicked",
+        "_timer",
+        "_phase",
+        "_flags",
+        "_token",
+        "_phase_changed",
+        "_profiler",
+        "_idle_timeout",
+        "_restore_flags",
+        "__weakref__",
+    )
+    registry = StateRegistry()
+    # False for states that run their own loop, stepping a parent runs them to the end in one step
+    _steppable = True
 
     def __init__(self, name, outcomes=[]):
         self.name = name
         self.outcomes = outcomes
-        self._paused = LockedVariable(False)
-        self._preempted = LockedVariable(False)
-        self._aborted = LockedVariable(False)
-        self._running = LockedVariable(False)
-        self._beginning = LockedVariable(False)
-        self._executing = LockedVariable(False)
-        self._ending = LockedVariable(False)
-        AbstractState._states.append(self)
+        self._phase = Phase.IDLE
+        self._flags = 0
+        # single lock guarding _phase and _flags, notified on every change and, while running, when the token
+        # is cancelled
+        self._phase_changed = Condition()
+        self._token = CancelToken(self)
+        self._profiler = None
+        self.idle_strategy = _default_idle_strategy
+        self._idle_timeout = None
+        self.rate = None
+        self.timeout = None
+        self.watchdog = None
+        self._deadline = None
+        self._kicked = None
+        self._timer = None
+        self._restore_flags = 0
+        AbstractState.registry.add(self)
 
     def _run(self, data=None):
         self.reset()
         outcome = None
-        self._begin(data)
-        self._executing.store(True)
-        while not (self.is_preempted() or self.is_aborted() or not outcome is None):
-            if self.is_paused():
-                self._idle(data)
-            else:
-                outcome = self._execute(data)
-        self._executing.store(False)
-        if self.is_aborted():
-            return "__aborted__"
-        if self.is_preempted():
-            return "__preempted__"
+        if self._token.flags & _STOPPED:
+            # the hierarchy was stopped while we were being entered
+            return _stopped_outcome(self._token.flags)
+        token = self._token
+        token.join(self._phase_changed)
+        try:
+            if self.timeout is not None or self.watchdog is not None:
+                self._arm()
+            self._begin(data)
+            self._set_phase(Phase.EXECUTING)
+            rate = self.rate
+            if rate is not None:
+                rate.reset()
+            flags = self._get_flags()
+            while not (flags & _STOPPED or not outcome is None):
+                if flags & PAUSED:
+                    self._idle(data)
+                    if rate is not None:
+                        rate.reset()
+                else:
+                    outcome = self._execute(data)
+                    if rate is not None and outcome is None:
+                        rate.sleep(self)
+                flags = self._get_flags()
+            return self._leave(outcome, data)
+        finally:
+            token.leave(self._phase_changed)
+
+    def _leave(self, outcome, data):
+        if self._timer is not None:
+            self._disarm()
+        self._set_phase(Phase.IDLE)
+        flags = self._get_flags()
+        if flags & (ABORTED | PREEMPTED):
+            return _stopped_outcome(flags)
         self._end(data)
-        return outcome
+        # an outcome reached just as the timer fired still wins
+        return "__timeout__" if outcome is None else outcome
+
+    def _step(self, data=None):
+        # one pass of the _run loop without waiting, entering on the first call; None until finished
+        rate = self.rate
+        if self._phase != Phase.EXECUTING:
+            self.reset()
+            if self._token.flags & _STOPPED:
+                return _stopped_outcome(self._token.flags)
+            # only running states are woken by a cancel, the cost of a stop follows the active path
+            self._token.join(self._phase_changed)
+            if self.timeout is not None or self.watchdog is not None:
+                self._arm()
+            self._begin(data)
+            self._set_phase(Phase.EXECUTING)
+            if rate is not None:
+                rate.reset()
+        outcome = None
+        flags = self._get_flags()
+        if not flags & _STOPPED:
+            if flags & PAUSED:
+                self._call_hook(self.idle, Profiler.IDLE, data)
+                self._idle_timeout = self.idle_strategy.next_timeout(self._idle_timeout)
+                if rate is not None:
+                    rate.reset()
+                return None
+            try:
+                outcome = self._step_execute(data)
+            except BaseException:
+                # the next step enters again instead of resuming a broken run
+                self._disarm()
+                self._set_phase(Phase.IDLE)
+                self._token.leave(self._phase_changed)
+                raise
+            if outcome is None:
+                # a stop raised meanwhile is handled by the next step
+                if rate is not None:
+                    rate.advance(self)
+                return None
+        try:
+            return self._leave(outcome, data)
+        finally:
+            self._token.leave(self._phase_changed)
+
+    def _step_execute(self, data):
+        return self._execute(data)
+
+    def _step_delay(self):
+        # seconds until stepping again is useful: the idle period while paused, the rate deadline otherwise;
+        # None while paused with a blocking idle strategy. only a hint, flags are read without the lock
+        flags = self._flags | self._token.flags
+        if self._phase != Phase.EXECUTING or flags & _STOPPED:
+            return 0.0
+        if flags & PAUSED:
+            return self._idle_timeout
+        rate = self.rate
+        return 0.0 if rate is None else max(0.0, rate.deadline - perf_counter())
+
+    def _get_flags(self):
+        with self._phase_changed:
+            return self._flags | self._token.flags
+
+    def _get_phase(self):
+        with self._phase_changed:
+            return self._phase
+
+    def _set_phase(self, phase):
+        with self._phase_changed:
+            self._phase = phase
+            self._phase_changed.notify_all()
+
+    def _set_flag(self, flag, value=True):
+        with self._phase_changed:
+            if value:
+                self._flags |= flag
+            else:
+                # also cleared from flags restored from a checkpoint but not applied yet
+                self._flags &= ~flag
+                self._restore_flags &= ~flag
+            self._phase_changed.notify_all()
+
+    def _will_pause(self):
+        # paused, or entered paused once flags restored from a checkpoint apply
+        return bool((self._get_flags() | self._restore_flags) & PAUSED)
+
+    def _is_quiescent(self):
+        # a paused state that is stopped still leaves its run, PAUSED stays set until the next reset
+        return self._phase == Phase.IDLE
+
+    def _owns_token(self):
+        return self._token.owner() is self
+
+    def _adopt(self, token):
+        if token is self._token:
+            return
+        self._token = token
+
+    def _stop(self, flag):
+        # the token owner stops everything below it at once, other states only stop themselves
+        if self._owns_token():
+            self._token.cancel(flag)
+        else:
+            self._set_flag(flag)
+
+    def _wait_quiescent(self, timeout=None):
+        with self._phase_changed:
+            return self._phase_changed.wait_for(self._is_quiescent, timeout)
 
     def _begin(self, data=None):
-        self._beginning.store(True)
-        self.begin(data)
-        self._beginning.store(False)
+        self._set_phase(Phase.BEGINNING)
+        self._call_hook(self.begin, Profiler.BEGIN, data)
+        self._set_phase(Phase.IDLE)
 
     def _execute(self, data=None):
-        outcome = self.execute(data)
+        outcome = self._call_hook(self.execute, Profiler.EXECUTE, data)
         return outcome
 
     def _end(self, data=None):
-        self._ending.store(True)
-        self.end(data)
-        self._ending.store(False)
+        self._set_phase(Phase.ENDING)
+        self._call_hook(self.end, Profiler.END, data)
+        self._set_phase(Phase.IDLE)
+
+    def _call_hook(self, hook, phase, data):
+        profiler = self._profiler
+        if profiler is None:
+            return hook(data)
+        start = perf_counter_ns()
+        try:
+            return hook(data)
+        finally:
+            profiler.record(self, phase, perf_counter_ns() - start)
 
     def _pause_in(self, data=None):
-        self._paused.store(True)
+        self._idle_timeout = None
+        self._set_flag(PAUSED)
         self.pause_in(data)
 
     def _pause_out(self, data=None):
         self.pause_out(data)
-        self._paused.store(False)
+        self._set_flag(PAUSED, False)
 
     def _abort(self, data=None):
-        self._aborted.store(True)
+        self._stop(ABORTED)
 
-    def _preempt(self, data=None):
-        self._preempted.store(True)
-        while self.is_beginning() or self.is_executing() or self.is_paused() or self.is_ending():
-            time.sleep(0.0001)
-        return True
+    def _preempt(self, data=None, timeout=None):
+        self._stop(PREEMPTED)
+        return self._wait_quiescent(timeout)
 
     def _idle(self, data=None):
-        self.idle(data)
+        self._call_hook(self.idle, Profiler.IDLE, data)
+        self._idle_timeout = self.idle_strategy.next_timeout(self._idle_timeout)
+        self._wait_resumed(self._idle_timeout)
+
+    def _is_resumed(self):
+        return not self._flags & PAUSED or (self._flags | self._token.flags) & _STOPPED
+
+    def _wait_resumed(self, timeout=None):
+        with self._phase_changed:
+            return self._phase_changed.wait_for(self._is_resumed, timeout)
+
+    def _wait_flagged(self, timeout=None):
+        # returns early if the state gets paused, preempted or aborted
+        with self._phase_changed:
+            return self._phase_changed.wait_for(self._get_flags_locked, timeout)
+
+    def _get_flags_locked(self):
+        return self._flags | self._token.flags
+
+    def set_rate(self, hz, policy="sleep"):
+        self.rate = None if hz is None else Rate(hz, policy)
+
+    def set_timeout(self, timeout, watchdog=None):
+        # past timeout seconds in total, or watchdog seconds without kick(), the state ends with __timeout__
+        self.timeout = timeout
+        self.watchdog = watchdog
+
+    def kick(self):
+        self._kicked = time.monotonic()
+
+    def _arm(self):
+        now = time.monotonic()
+        self._deadline = None if self.timeout is None else now + self.timeout
+        self._kicked = now
+        # scheduled under the lock, an entry firing right away must find itself in _timer
+        with self._phase_changed:
+            self._timer = default_scheduler().schedule(self._next_due(), self._on_timer)
+
+    def _disarm(self):
+        with self._phase_changed:
+            entry, self._timer = self._timer, None
+        if entry is not None:
+            default_scheduler().cancel(entry)
+
+    def _next_due(self):
+        due = self._deadline
+        if self.watchdog is not None and (due is None or self._kicked + self.watchdog < due):
+            due = self._kicked + self.watchdog
+        return due
+
+    def _on_timer(self, entry):
+        with self._phase_changed:
+            if self._timer is not entry:
+                return  # disarmed, or armed again by a later run
+            due = self._next_due()
+            if due > time.monotonic():
+                # kicked since this entry was scheduled
+                self._timer = default_scheduler().schedule(due, self._on_timer)
+                return
+            self._timer = None
+            self._set_flag(TIMED_OUT)
+        self._time_out()
+
+    def _time_out(self):
+        pass
 
     def reset(self):
-        self._paused.store(False)
-        self._preempted.store(False)
-        self._aborted.store(False)
-        self._running.store(False)
-        self._beginning.store(False)
-        self._ending.store(False)
-        self._executing.store(False)
+        with self._phase_changed:
+            self._phase = Phase.IDLE
+            # flags recovered from a checkpoint survive exactly one reset
+            self._flags = self._restore_flags
+            self._restore_flags = 0
+            if self._owns_token():
+                self._token.clear()
+            self._phase_changed.notify_all()
+        self._idle_timeout = None
+
+    def status(self):
+        with self._phase_changed:
+            phase, flags = self._phase, self._flags | self._token.flags
+        return StateStatus(phase, bool(flags & PAUSED), bool(flags & PREEMPTED), bool(flags & ABORTED))
 
     def is_paused(self):
-        return self._paused.retr()
+        return bool(self._get_flags() & PAUSED)
 
     def is_preempted(self):
-        return self._preempted.retr()
+        return bool(self._get_flags() & PREEMPTED)
 
     def is_aborted(self):
-        return self._aborted.retr()
+        return bool(self._get_flags() & ABORTED)
+
+    def is_timed_out(self):
+        return bool(self._get_flags() & TIMED_OUT)
 
     def is_ending(self):
-        return self._ending.retr()
+        return self._get_phase() == Phase.ENDING
 
     def is_beginning(self):
-        return self._beginning.retr()
-
-    def is_paused(self):
-        return self._paused.retr()
+        return self._get_phase() == Phase.BEGINNING
 
     def is_executing(self):
-        return self._executing.retr()
+        return self._get_phase() == Phase.EXECUTING
 
     def pause(self, pause):
-        if pause == False and self._paused.retr():
+        if pause == False and self.is_paused():
             self._pause_out()
-        elif pause == True and not self._paused.retr():
+        elif pause == True and not self.is_paused():
             self._pause_in()
-        return self._paused.retr()
+        return self.is_paused()
+
+    def preempt(self, timeout=None, wait=True):
+        # wait=False only requests the stop, for states driven by step(): the next step ends the run
+        if not wait:
+            self._preempt(None, 0)
+            return True
+        if not self._preempt(None, timeout):
+            raise PreemptTimeout(self._blocking_state(), timeout)
+        return True
+
+    def step(self, data=None):
+        # one execute on the calling thread, entering the state first and taking the transitions it leads to;
+        # returns the outcome once the state has finished, None before. paused states only call idle()
+        self._check_steppable()
+        return self._step(data)
+
+    def tick(self, n=1, data=None):
+        # up to n steps, stops at the outcome
+        self._check_steppable()
+        step = self._step
+        for i in range(n):
+            outcome = step(data)
+            if outcome is not None:
+                return outcome
+        return None
+
+    def _check_steppable(self):
+        if not self._steppable:
+            raise TypeError("%s %s runs its own loop and cannot be stepped" % (type(self).__name__, self.name))
+
+    def _blocking_state(self):
+        return self
 
     def begin(self, data=None):
         raise NotImplementedError
@@ -143,58 +767,625 @@ class AbstractState(object):
         raise NotImplementedError
 
     def idle(self, data=None):
-        # raise NotImplementedError
-        time.sleep(0.1)
+        # called while paused, _idle then waits according to idle_strategy
+        pass
+
+
+class Profiler(object):
+    BEGIN = 0
+    EXECUTE = 1
+    END = 2
+    IDLE = 3
+    _phase_names = ("begin", "execute", "end", "idle")
+    # histogram upper bounds in nanoseconds, 1us to 10s
+    default_bounds = (1000, 10000, 100000, 1000000, 10000000, 100000000, 1000000000, 10000000000)
+
+    def __init__(self, bounds=default_bounds):
+        self.bounds = tuple(bounds)
+        self._stats = {}
+        self._paths = {}
+        self._transitions = {}
+        self._lock = Lock()
+
+    def attach(self, state, machine=None):
+        # states are told apart by their path from the attached root, "mission/dock/approach", so
+        # same-named states of different machines keep their own histograms
+        path = state.name if machine is None else self._paths.get(machine, machine.name) + "/" + state.name
+        # histograms are allocated here so that record() never allocates
+        with self._lock:
+            self._paths[state] = path
+            if path not in self._stats:
+                self._stats[path] = [[0] * (len(self.bounds) + 3) for phase in self._phase_names]
+        state._profiler = self
+        if isinstance(state, StateMachine):
+            for child in state.states.values():
+                self.attach(child, state)
+        return self
+
+    def detach(self, state):
+        state._profiler = None
+        if isinstance(state, StateMachine):
+            for child in state.states.values():
+                self.detach(child)
+
+    def record(self, state, phase, duration):
+        # histogram layout: [count, sum, bucket_0, ..., bucket_inf]
+        histogram = self._stats[self._paths[state]][phase]
+        bucket = bisect_left(self.bounds, duration)
+        with self._lock:
+            histogram[0] += 1
+            histogram[1] += duration
+            histogram[bucket + 2] += 1
+
+    def record_transition(self, machine, state, outcome, target):
+        key = (self._paths.get(machine, machine.name), state.name, outcome, None if target is None else target.name)
+        with self._lock:
+            self._transitions[key] = self._transitions.get(key, 0) + 1
+
+    def reset(self):
+        with self._lock:
+            for histograms in self._stats.values():
+                for histogram in histograms:
+                    histogram[:] = [0] * len(histogram)
+            self._transitions.clear()
+
+    def to_dict(self):
+        with self._lock:
+            states = {}
+            for name, histograms in self._stats.items():
+                states[name] = {}
+                for phase, histogram in zip(self._phase_names, histograms):
+                    states[name][phase] = {
+                        "count": histogram[0],
+                        "sum_ns": histogram[1],
+                        "buckets": dict(zip(self.bounds + (None,), histogram[2:])),
+                    }
+            transitions = [
+                {"machine": machine, "from": state, "outcome": outcome, "to": target, "count": count}
+                for (machine, state, outcome, target), count in self._transitions.items()
+            ]
+        return {"bounds_ns": list(self.bounds), "states": states, "transitions": transitions}
+
+    def to_prometheus(self):
+        stats = self.to_dict()
+        lines = ["# TYPE state_machine_phase_seconds histogram"]
+        for name, phases in stats["states"].items():
+            for phase, histogram in phases.items():
+                labels = 'state="%s",phase="%s"' % (_escape_label(name), phase)
+                cumulative = 0
+                for bound, count in histogram["buckets"].items():
+                    cumulative += count
+                    le = "+Inf" if bound is None else repr(bound / 1e9)
+                    lines.append('state_machine_phase_seconds_bucket{%s,le="%s"} %d' % (labels, le, cumulative))
+                lines.append("state_machine_phase_seconds_sum{%s} %r" % (labels, histogram["sum_ns"] / 1e9))
+                lines.append("state_machine_phase_seconds_count{%s} %d" % (labels, histogram["count"]))
+        lines.append("# TYPE state_machine_transitions_total counter")
+        for transition in stats["transitions"]:
+            labels = 'machine="%s",from="%s",outcome="%s",to="%s"' % tuple(
+                _escape_label(transition[key]) for key in ("machine", "from", "outcome", "to")
+            )
+            lines.append("state_machine_transitions_total{%s} %d" % (labels, transition["count"]))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        # written next to the target then renamed, so scrapers never read a partial file
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MonitorEvent(str):
+    # compares equal to the bare event name so existing callbacks keep working
+    def __new__(cls, event, state_name, timestamp=None):
+        self = str.__new__(cls, event)
+        self.state = state_name
+        self.timestamp = time.time() if timestamp is None else timestamp
+        return self
+
+
+class InlineDispatcher(object):
+    def dispatch(self, event_cb, event):
+        event_cb(event)
+
+    def flush(self, timeout=None):
+        return True
+
+    def close(self):
+        pass
+
+
+class QueueDispatcher(object):
+    _policies = ("block", "drop", "coalesce")
+
+    def __init__(self, workers=1, maxsize=1024, policy="block"):
+        if policy not in self._policies:
+            raise ValueError("unknown dispatch policy %s" % policy)
+        self.policy = policy
+        self.dropped = 0
+        self._queue = Queue(maxsize)
+        self._pending = {}
+        self._pending_lock = Lock()
+        self._workers = []
+        for i in range(workers):
+            worker = Thread(target=self._work, name="state_machine_dispatch_%d" % i, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def dispatch(self, event_cb, event):
+        if self.policy == "coalesce":
+            key = (event_cb, event.state, str(event))
+            with self._pending_lock:
+                if key in self._pending:
+                    self.dropped += 1
+                    return
+                self._pending[key] = event
+            self._queue.put((event_cb, event, key))
+        elif self.policy == "drop":
+            try:
+                self._queue.put_nowait((event_cb, event, None))
+            except Full:
+                self.dropped += 1
+        else:
+            self._queue.put((event_cb, event, None))
+
+    def flush(self, timeout=None):
+        if timeout is None:
+            self._queue.join()
+            return True
+        deadline = time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self):
+        for worker in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            event_cb, event, key = item
+            if key is not None:
+                with self._pending_lock:
+                    del self._pending[key]
+            try:
+                event_cb(event)
+            except Exception:
+                import traceback
+
+                traceback.print_exc()
+            finally:
+                self._queue.task_done()
+
+
+class ThreadPoolDispatcher(QueueDispatcher):
+    # events are spread over several workers, so ordering between them is not guaranteed
+    def __init__(self, workers=4, maxsize=1024, policy="block"):
+        QueueDispatcher.__init__(self, workers, maxsize, policy)
+
+
+_default_dispatcher = None
+_default_dispatcher_lock = Lock()
+
+
+def default_dispatcher():
+    global _default_dispatcher
+    with _default_dispatcher_lock:
+        if _default_dispatcher is None:
+            _default_dispatcher = QueueDispatcher()
+        return _default_dispatcher
 
 
 class MonitoredState(AbstractState):
+    __slots__ = ("event_cb", "dispatcher")
     _event_names = ["on_begin", "on_execute", "on_end", "on_pause_in", "on_pause_out", "on_preempt", "on_abort"]
 
-    def __init__(self, name, event_cb, outcomes=[]):
+    def __init__(self, name, event_cb, outcomes=[], dispatcher=None):
         AbstractState.__init__(self, name, outcomes)
         self.event_cb = event_cb
+        self.dispatcher = default_dispatcher() if dispatcher is None else dispatcher
+
+    def _notify(self, event):
+        self.dispatcher.dispatch(self.event_cb, MonitorEvent(event, self.name))
+
+    def _run(self, data=None):
+        if self._owns_token():
+            return AbstractState._run(self, data)
+        # stops of the hierarchy above do not go through _preempt/_abort, report them from the token
+        self._token.watch(self._on_stopped)
+        try:
+            return AbstractState._run(self, data)
+        finally:
+            self._token.unwatch(self._on_stopped)
 
-    def _begin(self, data):
-        Thread(target=self.event_cb, args=("on_begin",)).start()
+    def _step(self, data=None):
+        if self._owns_token():
+            return AbstractState._step(self, data)
+        if self._phase != Phase.EXECUTING:
+            self._token.watch(self._on_stopped)
+        try:
+            outcome = AbstractState._step(self, data)
+        except BaseException:
+            self._token.unwatch(self._on_stopped)
+            raise
+        if outcome is not None:
+            self._token.unwatch(self._on_stopped)
+        return outcome
+
+    def _on_stopped(self, flag):
+        self._notify("on_abort" if flag == ABORTED else "on_preempt")
+
+    def _begin(self, data=None):
+        self._notify("on_begin")
         AbstractState._begin(self, data)
 
-    def _execute(self, data):
-        Thread(target=self.event_cb, args=("on_execute",)).start()
+    def _execute(self, data=None):
+        self._notify("on_execute")
         return AbstractState._execute(self, data)
 
-    def _end(self, data):
-        Thread(target=self.event_cb, args=("on_end",)).start()
+    def _end(self, data=None):
+        self._notify("on_end")
         AbstractState._end(self, data)
 
     def _pause_in(self, data=None):
-        Thread(target=self.event_cb, args=("on_pause_in",)).start()
+        self._notify("on_pause_in")
         AbstractState._pause_in(self, data)
 
-    def _pause_out(self, data):
-        Thread(target=self.event_cb, args=("on_pause_out",)).start()
+    def _pause_out(self, data=None):
+        self._notify("on_pause_out")
         AbstractState._pause_out(self, data)
 
-    def _preempt(self):
-        Thread(target=self.event_cb, args=("on_preempt",)).start()
-        AbstractState._preempt(self)
+    def _preempt(self, data=None, timeout=None):
+        self._notify("on_preempt")
+        return AbstractState._preempt(self, data, timeout)
 
-    def _abort(self, data):
-        Thread(target=self.event_cb, args=("on_abort",)).start()
+    def _abort(self, data=None):
+        self._notify("on_abort")
         AbstractState._abort(self, data)
 
 
+TransitionRecord = namedtuple(
+    "TransitionRecord", ["timestamp_ns", "machine", "state", "outcome", "target", "duration_ns"]
+)
+
+
+class TransitionLog(object):
+    # fixed-size ring buffer, append() only stores references into preallocated slots
+    _magic = b"SMT2"
+    _header = struct.Struct("<4sII")
+    _record = struct.Struct("<QIIIIQ")
+    _length = struct.Struct("<I")
+    _none = 0xFFFFFFFF
+    # by magic: record, string length and missing name, SMTL files have 16 bit string indexes and lengths
+    _formats = {b"SMTL": (struct.Struct("<QHHHHQ"), struct.Struct("<H"), 0xFFFF), _magic: (_record, _length, _none)}
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self._timestamps = [0] * capacity
+        self._machines = [None] * capacity
+        self._states = [None] * capacity
+        self._outcomes = [None] * capacity
+        self._targets = [None] * capacity
+        self._durations = [0] * capacity
+        self._counter = count()
+        self._written = 0
+        self._lock = Lock()
+
+    def append(self, machine, state, outcome, target, duration_ns):
+        # next() on itertools.count is atomic, concurrent machines never share a slot
+        written = next(self._counter)
+        i = written % self.capacity
+        self._timestamps[i] = time.time_ns()
+        self._machines[i] = machine
+        self._states[i] = state
+        self._outcomes[i] = outcome
+        self._targets[i] = None if target is None else target.name
+        self._durations[i] = duration_ns
+        # appends finish out of order, _written must never go back
+        with self._lock:
+            if written >= self._written:
+                self._written = written + 1
+
+    def records(self):
+        written = self._written
+        first = max(0, written - self.capacity)
+        records = []
+        for n in range(first, written):
+            i = n % self.capacity
+            records.append(
+                TransitionRecord(
+                    self._timestamps[i],
+                    self._machines[i],
+                    self._states[i],
+                    self._outcomes[i],
+                    self._targets[i],
+                    self._durations[i],
+                )
+            )
+        return records
+
+    def clear(self):
+        with self._lock:
+            self._counter = count()
+            self._written = 0
+
+    def __len__(self):
+        return min(self._written, self.capacity)
+
+    def dump_jsonl(self, path):
+        import json
+
+        with open(path, "w") as f:
+            for record in self.records():
+                f.write(json.dumps(record._asdict()) + "\n")
+
+    def dump_binary(self, path):
+        records = self.records()
+        strings, index = [], {}
+        for record in records:
+            for value in record[1:5]:
+                if value is not None and value not in index:
+                    index[value] = len(strings)
+                    strings.append(value)
+        parts = [self._header.pack(self._magic, len(strings), len(records))]
+        for string in strings:
+            encoded = string.encode()
+            parts.append(self._length.pack(len(encoded)) + encoded)
+        for record in records:
+            ids = [self._none if value is None else index[value] for value in record[1:5]]
+            parts.append(self._record.pack(record.timestamp_ns, *ids, record.duration_ns))
+        with open(path, "wb") as f:
+            f.write(b"".join(parts))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            content = f.read()
+        if content[:4] not in cls._formats:
+            import json
+
+            return [TransitionRecord(**json.loads(line)) for line in content.decode().splitlines() if line]
+        magic, string_count, record_count = cls._header.unpack_from(content)
+        record_struct, length_struct, none = cls._formats[magic]
+        offset = cls._header.size
+        strings = []
+        for i in range(string_count):
+            (length,) = length_struct.unpack_from(content, offset)
+            offset += length_struct.size
+            strings.append(content[offset : offset + length].decode())
+            offset += length
+        records = []
+        for timestamp_ns, *ids, duration_ns in record_struct.iter_unpack(content[offset:]):
+            names = [None if i == none else strings[i] for i in ids]
+            records.append(TransitionRecord(timestamp_ns, *names, duration_ns))
+        return records[:record_count]
+
+
+default_transition_log = TransitionLog()
+
+
+def replay(machine, records):
+    # re-drives the compiled transition tables of this definition with the logged outcomes and returns
+    # (record, expected state, expected target) for every record the definition disagrees with
+    machines = {}
+    pending = [machine]
+    while pending:
+        current = pending.pop()
+        current.compile()
+        machines.setdefault(current.name, current)
+        pending.extend(state for state in current.states.values() if isinstance(state, StateMachine))
+    # a ring buffer can start mid-run, the first record of each machine tells where it was
+    positions = dict.fromkeys(machines)
+    mismatches = []
+    for record in records:
+        current = machines.get(record.machine)
+        if current is None:
+            continue
+        position = positions[record.machine]
+        if position is None:
+            position = current.states.get(record.state)
+            if position is None:
+                mismatches.append((record, None, None))
+                continue
+        if record.outcome == "__aborted__":
+            target = None
+        elif record.outcome == "__preempted__":
+            target = current.initial_state
+        else:
+            target = current._routes[position].get(record.outcome)
+            if type(target) is _Decision:
+                # the guards depended on data the log does not keep, any of their targets agrees
+                targets = [state for state in target.targets() if state is not _UNROUTED]
+                target = next((state for state in targets if getattr(state, "name", None) == record.target), None)
+        target_name = None if target is None else target.name
+        if record.state != position.name or record.target != target_name:
+            mismatches.append((record, position.name, target_name))
+        if target is None:
+            # the machine finished, its next run starts over
+            positions[record.machine] = current.initial_state
+        else:
+            positions[record.machine] = target
+            if isinstance(target, StateMachine) and target.name in positions:
+                positions[target.name] = target.initial_state
+    return mismatches
+
+
+_OPERATORS = {
+    "==": eq,
+    "!=": ne,
+    "<": lt,
+    "<=": le,
+    ">": gt,
+    ">=": ge,
+    "in": lambda value, container: contains(container, value),
+    "not in": lambda value, container: not contains(container, value),
+}
+
+
+def when(name, op, value):
+    # predicate over one PassingData value, for definitions that cannot hold code; a missing value never holds
+    try:
+        compare = _OPERATORS[op]
+    except KeyError:
+        raise ValueError("unknown guard operator %s" % op)
+
+    def predicate(data):
+        return data is not None and name in data and compare(data.get(name), value)
+
+    return predicate
+
+
+class Guard(object):
+    # one branch of a transition, taken when predicate(data) holds; higher priorities are tried first,
+    # equal ones in the order given, and a branch without predicate ends the search
+    __slots__ = ("target", "predicate", "priority")
+
+    def __init__(self, target, predicate=None, priority=0):
+        self.target = target
+        self.predicate = predicate
+        self.priority = priority
+
+
+class _Decision(object):
+    # compiled guards of one outcome: (predicate, state) rows, then the state taken when none holds
+    __slots__ = ("branches", "default")
+
+    def __init__(self, branches, default):
+        self.branches = branches
+        self.default = default
+
+    def select(self, data):
+        for predicate, target in self.branches:
+            if predicate(data):
+                return target
+        return self.default
+
+    def targets(self):
+        return [target for predicate, target in self.branches] + [self.default]
+
+
+def _guards(target):
+    # a transition value is a state name, a Guard, or a list of both
+    if isinstance(target, (str, Guard)):
+        target = [target]
+    return [Guard(guard) if isinstance(guard, str) else guard for guard in target]
+
+
+def _targets(transitions):
+    for target in transitions.values():
+        if isinstance(target, str):
+            yield target
+        else:
+            for guard in _guards(target):
+                yield guard.target
+
+
+class LazyState(object):
+    # stands in for a state until a machine first enters it, keeping only what compile() needs
+    __slots__ = ("name", "outcomes", "factory", "args", "kwargs", "timeout", "watchdog", "rate", "state", "_profiler")
+
+    def __init__(self, name, factory, outcomes=[], args=(), kwargs=None):
+        self.name = name
+        self.outcomes = outcomes
+        self.factory = factory
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.timeout = None
+        self.watchdog = None
+        self.rate = None
+        self.state = None
+        self._profiler = None
+
+    def set_rate(self, hz, policy="sleep"):
+        self.rate = (hz, policy)
+        if self.state is not None:
+            self.state.set_rate(hz, policy)
+
+    def set_timeout(self, timeout, watchdog=None):
+        self.timeout = timeout
+        self.watchdog = watchdog
+        if self.state is not None:
+            self.state.set_timeout(timeout, watchdog)
+
+    def build(self):
+        state = self.factory(*self.args, **self.kwargs)
+        if state.name != self.name:
+            raise TransitionError("lazy state %s built a state named %s" % (self.name, state.name))
+        if self.rate is not None:
+            state.set_rate(*self.rate)
+        if self.timeout is not None or self.watchdog is not None:
+            state.set_timeout(self.timeout, self.watchdog)
+        self.state = state
+        return state
+
+    def release(self):
+        if self.state is not None:
+            # an evicted state no longer takes part in the machine's cancellations
+            self.state._adopt(CancelToken(self.state))
+        self.state = None
+
+    def _adopt(self, token):
+        if self.state is not None:
+            self.state._adopt(token)
+
+
 class StateMachine(AbstractState):
+    __slots__ = (
+        "states",
+        "transitions",
+        "initial_state",
+        "current_state",
+        "_routes",
+        "_outcome_set",
+        "_checkpoint",
+        "_checkpoint_key",
+        "_resume_state",
+        "transition_log",
+        "_entered_ns",
+        "_flat",
+        "lazy_capacity",
+        "_materialized",
+    )
+    _special_outcomes = ("__preempted__", "__aborted__")
+
     def __init__(self, name, outcomes=[], starting_data=None):
         AbstractState.__init__(self, name, outcomes)
         self.states = dict()
         self.transitions = dict()
         self.initial_state = None
         self.current_state = None
+        self._routes = None
+        self._outcome_set = frozenset(outcomes)
+        self._checkpoint = None
+        self._checkpoint_key = None
+        self._resume_state = None
+        self.transition_log = default_transition_log
+        self._entered_ns = perf_counter_ns()
+        self._flat = False
+        # built LazyStates kept at most, least recently entered first out; None keeps all of them
+        self.lazy_capacity = None
+        self._materialized = OrderedDict()
 
     def add_state(self, state, transitions, initial=False):
         name = state.name
         self.states[name] = state
         self.transitions[name] = transitions
+        self._routes = None
         if initial:
             if self.initial_state is None:
                 self.initial_state = state
@@ -202,47 +1393,286 @@ class StateMachine(AbstractState):
             else:
                 raise Exception("initial state already set")
 
+    def compile(self):
+        if len(self.states) == 0:
+            raise TransitionError("State Machine %s has no states" % self.name)
+        if self.initial_state is None:
+            self.initial_state = next(iter(self.states.values()))
+            self.current_state = self.initial_state
+        self._outcome_set = frozenset(self.outcomes)
+        routes = dict()
+        for name, state in self.states.items():
+            transitions = self.transitions[name]
+            self._validate_state(name, state, transitions)
+            route = dict.fromkeys(self._outcome_set)
+            for outcome, target in transitions.items():
+                route[outcome] = self.states[target] if isinstance(target, str) else self._decision(outcome, target)
+            routes[state] = route
+            if type(state) is LazyState and state.state is not None:
+                routes[state.state] = route
+            state._adopt(self._token)
+        self._validate_reachable()
+        for state in self.states.values():
+            if isinstance(state, StateMachine):
+                state.compile()
+        self._routes = routes
+        return self
+
+    def _decision(self, outcome, target):
+        branches = []
+        default = None if outcome in self._outcome_set else _UNROUTED
+        for guard in sorted(_guards(target), key=lambda guard: -guard.priority):
+            if guard.predicate is None:
+                default = self.states[guard.target]
+                break
+            branches.append((guard.predicate, self.states[guard.target]))
+        return _Decision(tuple(branches), default)
+
+    def _validate_state(self, name, state, transitions):
+        for target in _targets(transitions):
+            if target not in self.states:
+                raise TransitionError(
+                    "State Machine %s: transition %s -> %s targets unknown state" % (self.name, name, target)
+                )
+        for outcome in state.outcomes:
+            if not (outcome in transitions or outcome in self._outcome_set or outcome in self._special_outcomes):
+                raise TransitionError(
+                    "State Machine %s: outcome %s of state %s has no transition" % (self.name, outcome, name)
+                )
+        if state.timeout is not None or state.watchdog is not None:
+            if not ("__timeout__" in transitions or "__timeout__" in self._outcome_set):
+                raise TransitionError(
+                    "State Machine %s: state %s has a timeout but no __timeout__ transition" % (self.name, name)
+                )
+
+    def _validate_reachable(self):
+        reachable = {self.initial_state.name}
+        pending = [self.initial_state.name]
+        while pending:
+            for target in _targets(self.transitions[pending.pop()]):
+                if target not in reachable:
+                    reachable.add(target)
+                    pending.append(target)
+        unreachable = [name for name in self.states if name not in reachable]
+        if unreachable:
+            raise TransitionError("State Machine %s: unreachable states %s" % (self.name, ", ".join(unreachable)))
+
+    def flatten(self):
+        # nested machines stop paying for their own _run: this machine steps the leaf states and
+        # calls the nested begin/end hooks itself, nested machines then stay IDLE while they run.
+        # there is no merged table, each level still routes through its own, so dispatch is O(depth)
+        self.compile()
+        self._flat = True
+        return self
+
     def pause_in(self, data=None):
         self.current_state._pause_in(data)
 
     def pause_out(self, data=None):
-        self.current_state._pause_out(data)
+        # every pause reaches the running state, as in pause_in. a state not entered yet and not paused, for
+        # instance the current state restored from a checkpoint taken before it was paused, gets no pause_out
+        state = self.current_state
+        if state._phase != Phase.IDLE or state._will_pause():
+            state._pause_out(data)
+
+    def _adopt(self, token):
+        AbstractState._adopt(self, token)
+        for state in self.states.values():
+            state._adopt(token)
+
+    def _blocking_state(self):
+        state = self.current_state
+        if state is None:
+            return self
+        blocking = state._blocking_state()
+        return self if blocking is state and state._is_quiescent() else blocking
 
     def begin(self, data=None):
-        if self.initial_state is None:
-            if len(self.states) == 0:
-                raise TransitionError("State Machine %s has no states".format(self.name))
-            self.initial_state = self.states.values[0]
+        if self._routes is None:
+            self.compile()
 
     def execute(self, data=None):
+        if self._flat:
+            return self._execute_flat(data)
         outcome = None
-        while not (outcome in self.outcomes or self.is_aborted() or self.is_preempted()):
-            outcome = self.current_state._run(data)
-            if outcome is not None:
-                if outcome == "__preempted__":
-                    self.current_state = self.initial_state
-                    outcome = None
-                elif outcome == "__aborted__":
-                    return outcome
-                elif outcome in self.transitions[self.current_state.name]:
-                    self.current_state = self.states[self.transitions[self.current_state.name][outcome]]
-                elif outcome not in self.outcomes:  # outcome not in state transitions nor in Statemachine outcomes
-                    raise TransitionError("outcome neither in state transitions nor in Statemachine outcomes")
+        while not (outcome in self._outcome_set or self._get_flags() & _STOPPED):
+            outcome = self._transition(self.current_state._run(data), data)
+            if outcome == "__aborted__":
+                return outcome
         return outcome
 
+    def _step_execute(self, data):
+        if type(self).execute is not StateMachine.execute:
+            return self._execute(data)
+        # one step of the current state, then its transition
+        outcome = self._transition(self.current_state._step(data), data)
+        return outcome if outcome in self._outcome_set or outcome == "__aborted__" else None
+
+    def _leave(self, outcome, data):
+        state = self.current_state
+        if outcome is None and state is not None and state._phase != Phase.IDLE:
+            # stopped between two steps: the active state takes its own stopped path first, as in _run
+            if not state._get_flags() & _STOPPED:
+                state._preempt(None, 0)
+            state._step(data)
+        return AbstractState._leave(self, outcome, data)
+
+    def _step_delay(self):
+        flags = self._flags | self._token.flags
+        if self._phase != Phase.EXECUTING or flags & (PAUSED | _STOPPED):
+            return AbstractState._step_delay(self)
+        return self.current_state._step_delay()
+
+    def _execute_flat(self, data):
+        stack = [self]
+        outcome = None
+        while True:
+            machine = stack[-1]
+            if outcome is None:
+                state = machine.current_state
+                if _flattens(state):
+                    outcome = state._enter(data)
+                    if outcome is None:
+                        stack.append(state)
+                        continue
+                else:
+                    outcome = state._run(data)
+            outcome = machine._transition(outcome, data)
+            finished = outcome in machine._outcome_set or outcome == "__aborted__"
+            flags = machine._get_flags()
+            if machine is self:
+                if finished or flags & _STOPPED:
+                    for machine in stack[1:]:
+                        machine._disarm()
+                    return outcome
+                outcome = None
+                continue
+            # what the nested _run would have returned to its parent
+            if flags & (ABORTED | PREEMPTED):
+                outcome = _stopped_outcome(flags)
+            elif not finished:
+                if not flags & TIMED_OUT:
+                    outcome = None
+                    continue
+                outcome = "__timeout__"
+            machine._disarm()
+            if not flags & (ABORTED | PREEMPTED):
+                machine._call_hook(machine.end, Profiler.END, data)
+            stack.pop()
+
+    def _enter(self, data):
+        self.reset()
+        flags = self._get_flags()
+        if not flags & _STOPPED:
+            if self.timeout is not None or self.watchdog is not None:
+                self._arm()
+            self._call_hook(self.begin, Profiler.BEGIN, data)
+            flags = self._get_flags()
+            if not flags & _STOPPED:
+                return None
+            self._disarm()
+            if not flags & (ABORTED | PREEMPTED):
+                self._call_hook(self.end, Profiler.END, data)
+        return _stopped_outcome(flags)
+
+    def _transition(self, outcome, data=None):
+        if outcome is None:
+            return outcome
+        state = self.current_state
+        if outcome == "__aborted__":
+            target = None
+        elif outcome == "__preempted__":
+            target = self.initial_state
+        else:
+            target = self._routes[state].get(outcome, _UNROUTED)
+            if type(target) is _Decision:
+                target = target.select(data)
+                if target is _UNROUTED:
+                    raise TransitionError(
+                        "State Machine %s: no guard of outcome %s of state %s holds" % (self.name, outcome, state.name)
+                    )
+            if target is _UNROUTED:  # outcome not in state transitions nor in Statemachine outcomes
+                raise TransitionError("outcome neither in state transitions nor in Statemachine outcomes")
+            if self._profiler is not None:
+                self._profiler.record_transition(self, state, outcome, target)
+        if self.transition_log is not None:
+            now = perf_counter_ns()
+            self.transition_log.append(self.name, state.name, outcome, target, now - self._entered_ns)
+            self._entered_ns = now
+        if target is not None:
+            if type(target) is LazyState:
+                target = self._materialize(target)
+            self.current_state = target
+            if self._checkpoint is not None:
+                self._checkpoint.record(self, target)
+        return None if outcome == "__preempted__" else outcome
+
     def end(self, data=None):
         pass
 
+    def _materialize(self, lazy):
+        state = lazy.state
+        if state is None:
+            state = lazy.build()
+            state._adopt(self._token)
+            if self._profiler is not None:
+                self._profiler.attach(state, self)
+            if self._routes is not None:
+                self._routes[state] = self._routes[lazy]
+                if isinstance(state, StateMachine):
+                    state.compile()
+            if self._checkpoint is not None:
+                self._checkpoint._built(self, state)
+            if self.lazy_capacity is not None:
+                while len(self._materialized) >= max(self.lazy_capacity, 1):
+                    self._evict(self._materialized.popitem(last=False)[0])
+            self._materialized[lazy] = True
+        else:
+            self._materialized.move_to_end(lazy)
+        return state
+
+    def _evict(self, lazy):
+        if self._routes is not None:
+            self._routes.pop(lazy.state, None)
+        lazy.release()
+
     def reset(self):
         AbstractState.reset(self)
-        self.current_state = self.initial_state
+        if self._routes is None and self.states:
+            # the default initial state is only known once compiled, and the checkpoint records it below
+            self.compile()
+        if self._resume_state is None:
+            self.current_state = self.initial_state
+        else:
+            self.current_state = self._resume_state
+            self._resume_state = None
+        if type(self.current_state) is LazyState:
+            self.current_state = self._materialize(self.current_state)
+        if self._checkpoint is not None:
+            self._checkpoint.record(self, self.current_state)
+        self._entered_ns = perf_counter_ns()
 
-    def _preempt(self):
-        self._preempted.store(True)
-        self.current_state._preempt()
-        while self.is_beginning() or self.is_executing() or self.is_paused() or self.is_ending():
-            time.sleep(0.0001)
-        return True
+    def set_rate(self, hz, policy="sleep"):
+        # applies to every state below this machine, each with its own deadlines
+        for state in self.states.values():
+            state.set_rate(hz, policy)
+
+    def _preempt(self, data=None, timeout=None):
+        if self._owns_token():
+            # the token wakes every level, each on its own condition, then only this machine is waited for
+            self._token.cancel(PREEMPTED)
+            return self._wait_quiescent(timeout)
+        self._set_flag(PREEMPTED)
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        if not self.current_state._preempt(data, timeout):
+            return False
+        if timeout is not None:
+            timeout = max(0.0, deadline - time.monotonic())
+        return self._wait_quiescent(timeout)
+
+    def _time_out(self):
+        self.current_state._preempt(None, 0)
 
     def preempt_restart(self, data=None):
         self._preempt()
@@ -251,5 +1681,571 @@ class StateMachine(AbstractState):
         return True
 
 
+def _flattens(state):
+    # subclasses with their own loop (AsyncStateMachine, custom execute) keep running it
+    return isinstance(state, StateMachine) and type(state).execute is StateMachine.execute and (
+        type(state)._run is AbstractState._run
+    )
+
+
+class Checkpoint(object):
+    # machines are known by the crc32 of their path from the root ("root/nested/lazy"), so a sub-machine
+    # built by a LazyState after the checkpoint was created finds its entries again
+    # snapshot file: header with the root's flags, then per machine its key, current state index and the
+    # flags of its current state, then the pickled PassingData values
+    # write-ahead log: one (machine key, state index) record per change of a machine's current state
+    _header = struct.Struct("<4sBIBH")
+    _entry = struct.Struct("<IHB")
+    _length = struct.Struct("<I")
+    _record = struct.Struct("<IH")
+    _magic = b"SMCP"
+    _version = 2
+    _none = 0xFFFF
+
+    def __init__(self, machine, path, flush=True):
+        self.machine = machine
+        self.path = path
+        self.log_path = path + ".wal"
+        self.flush = flush
+        self._machines = {}
+        self._paths = {}
+        self._states = {}
+        self._indexes = {}
+        self._pending = {}
+        self._waiting = None
+        self._attached = False
+        self._lock = Lock()
+        self._log = None
+        # the fingerprint only covers machines that exist up front, not those a LazyState builds
+        fingerprint = []
+        self._collect(machine, machine.name, fingerprint)
+        self._fingerprint = zlib.crc32("\0".join(fingerprint).encode())
+
+    def _collect(self, machine, path, fingerprint=None):
+        key = zlib.crc32(path.encode())
+        states = list(machine.states.values())
+        with self._lock:
+            machine._checkpoint_key = key
+            if self._attached:
+                machine._checkpoint = self
+            self._machines[key] = machine
+            self._paths[key] = path
+            self._states[key] = states
+            # keyed by name, a LazyState and the state it builds share their index
+            self._indexes[key] = dict((state.name, i) for i, state in enumerate(states))
+        if fingerprint is not None:
+            fingerprint.append(path + ":" + ",".join(machine.states))
+        for state in states:
+            if isinstance(state, StateMachine):
+                self._collect(state, path + "/" + state.name, fingerprint)
+            elif type(state) is LazyState and isinstance(state.state, StateMachine):
+                self._collect(state.state, path + "/" + state.name)
+
+    def _owns(self, state):
+        return self._machines.get(getattr(state, "_checkpoint_key", None)) is state
+
+    def _built(self, machine, state):
+        # called by machine when one of its LazyStates builds state
+        path = self._paths[machine._checkpoint_key] + "/" + state.name
+        if isinstance(state, StateMachine):
+            self._collect(state, path)
+        if self._waiting is not None and self._waiting[0] == zlib.crc32(path.encode()):
+            flags = self._waiting[1]
+            self._waiting = None
+            state._restore_flags = flags
+            if self._owns(state):
+                self._resume(state)
+
+    def attach(self):
+        self._log = open(self.log_path, "ab")
+        with self._lock:
+            self._attached = True
+            for machine in self._machines.values():
+                machine._checkpoint = self
+        return self
+
+    def detach(self):
+        with self._lock:
+            self._attached = False
+            for machine in self._machines.values():
+                machine._checkpoint = None
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+    def record(self, machine, state):
+        key = machine._checkpoint_key
+        record = self._record.pack(key, self._indexes[key][state.name])
+        if self._owns(state):
+            # entering a nested machine restarts it, even if it crashes before its own reset
+            nested = state._checkpoint_key
+            record += self._record.pack(nested, self._indexes[nested][state.initial_state.name])
+        with self._lock:
+            if self._log is not None:
+                self._log.write(record)
+                if self.flush:
+                    self._log.flush()
+
+    def save(self, data=None):
+        values = dict(data.snapshot()[0]) if isinstance(data, PassingData) else None
+        import pickle
+
+        payload = pickle.dumps(values, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            # idle states have their flags cleared when entered, only the active path carries any
+            entries = []
+            for key, machine in self._machines.items():
+                state = machine.current_state
+                if state is None:
+                    entries.append(self._entry.pack(key, self._none, 0))
+                else:
+                    entries.append(self._entry.pack(key, self._indexes[key][state.name], state._get_flags() & PAUSED))
+            flags = self.machine._get_flags() & PAUSED
+            header = self._header.pack(self._magic, self._version, self._fingerprint, flags, len(entries))
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(b"".join([header] + entries + [self._length.pack(len(payload)), payload]))
+            os.replace(tmp_path, self.path)
+            # the snapshot now covers every logged transition
+            if self._log is not None:
+                self._log.truncate(0)
+                self._log.seek(0)
+            else:
+                open(self.log_path, "wb").close()
+
+    def restore(self, data=None):
+        current = {}
+        snapshot = self._load_snapshot(current)
+        records = self._replay_log(current)
+        if snapshot is None and records == 0:
+            return False
+        flags, values = (0, None) if snapshot is None else snapshot
+        if records:
+            # the tree ran on after the snapshot, the flags it saved are stale
+            flags = 0
+            current = dict((key, (index, 0)) for key, (index, state_flags) in current.items())
+        self.machine._restore_flags = flags
+        self._pending = current
+        self._resume(self.machine)
+        if isinstance(data, PassingData) and values is not None:
+            for name, value in values.items():
+                data.set(name, value)
+        return True
+
+    def _resume(self, machine):
+        # only the active path resumes, machines off it restart from their initial state when entered
+        while True:
+            key = machine._checkpoint_key
+            index, flags = self._pending.pop(key, (self._none, 0))
+            if index == self._none:
+                break
+            state = self._states[key][index]
+            machine.current_state = machine._resume_state = state
+            if type(state) is LazyState:
+                if state.state is None:
+                    # built when machine enters it, _built() carries on from there
+                    self._waiting = (zlib.crc32((self._paths[key] + "/" + state.name).encode()), flags)
+                    if machine._checkpoint is None:
+                        machine._checkpoint = self
+                    return
+                state = state.state
+            state._restore_flags = flags
+            if not self._owns(state):
+                break
+            machine = state
+        self._pending = {}
+
+    def _load_snapshot(self, current):
+        try:
+            with open(self.path, "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+        magic, version, fingerprint, flags, count = self._header.unpack_from(content)
+        if magic != self._magic or version != self._version:
+            raise CheckpointError("%s is not a state machine checkpoint" % self.path)
+        if fingerprint != self._fingerprint:
+            raise CheckpointError("checkpoint %s does not match machine %s" % (self.path, self.machine.name))
+        offset = self._header.size
+        for i in range(count):
+            key, index, state_flags = self._entry.unpack_from(content, offset)
+            current[key] = (index, state_flags)
+            offset += self._entry.size
+        (length,) = self._length.unpack_from(content, offset)
+        offset += self._length.size
+        import pickle
+
+        return flags, pickle.loads(content[offset : offset + length])
+
+    def _replay_log(self, current):
+        try:
+            with open(self.log_path, "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            return 0
+        # a torn record at the end is a write interrupted by the crash, drop it
+        end = len(content) - len(content) % self._record.size
+        for key, index in self._record.iter_unpack(content[:end]):
+            current[key] = (index, 0)
+        return end // self._record.size
+
+
+class CheckpointError(Exception):
+    pass
+
+
+class ConcurrentState(AbstractState):
+    __slots__ = ("children", "join", "outcome_map", "default_outcome", "executor", "_results", "_running")
+    _joins = ("all", "any")
+    # the regions run on their own threads until the join
+    _steppable = False
+
+    def __init__(self, name, outcomes=[], join="all", outcome_map=None, default_outcome=None, executor=None):
+        if join not in self._joins:
+            raise ValueError("unknown join policy %s" % join)
+        AbstractState.__init__(self, name, outcomes)
+        self.children = []
+        self.join = join
+        # {outcome: {child name: child outcome}}, the first satisfied entry wins
+        self.outcome_map = outcome_map or {}
+        self.default_outcome = default_outcome
+        self.executor = executor
+        self._results = {}
+        self._running = []
+
+    def add_state(self, state):
+        self.children.append(state)
+        state._adopt(self._token)
+
+    def _adopt(self, token):
+        AbstractState._adopt(self, token)
+        for child in self.children:
+            child._adopt(token)
+
+    def _blocking_state(self):
+        with self._phase_changed:
+            running = list(self._running)
+        return running[0]._blocking_state() if running else self
+
+    def begin(self, data=None):
+        if len(self.children) == 0:
+            raise TransitionError("Concurrent state %s has no states" % self.name)
+
+    def execute(self, data=None):
+        with self._phase_changed:
+            if self._get_flags_locked() & _STOPPED:
+                return None
+            self._results = {}
+            self._running = list(self.children)
+        for child in self.children[:-1]:
+            if self.executor is not None:
+                self.executor.submit(self._run_child, child, data)
+            else:
+                Thread(target=self._run_child, args=(child, data), name=child.name).start()
+        # the last child runs on our own thread, one thread less per region
+        self._run_child(self.children[-1], data)
+        with self._phase_changed:
+            self._phase_changed.wait_for(self._all_finished)
+            results = dict(self._results)
+            outcome = self._decide(True)
+        if outcome is None and not self._get_flags() & _STOPPED:
+            raise TransitionError("Concurrent state %s: children outcomes %s match no outcome" % (self.name, results))
+        return outcome
+
+    def _run_child(self, child, data):
+        try:
+            outcome = child._run(data)
+        except BaseException:
+            outcome = "__aborted__"
+            import traceback
+
+            traceback.print_exc()
+        with self._phase_changed:
+            self._results[child.name] = outcome
+            self._running.remove(child)
+            decided = self._decide(False) is not None
+            losers = list(self._running) if decided else []
+            self._phase_changed.notify_all()
+        for loser in losers:
+            loser._preempt(None, 0)
+
+    def _all_finished(self):
+        return not self._running
+
+    def _decide(self, finished):
+        results = self._results
+        if "__aborted__" in results.values():
+            return "__aborted__"
+        for outcome, required in self.outcome_map.items():
+            if all(results.get(name) == child_outcome for name, child_outcome in required.items()):
+                return outcome
+        if self.join == "any":
+            for outcome in results.values():
+                if outcome not in ("__preempted__", "__aborted__"):
+                    return outcome
+        if not finished or self.join == "any" and self._get_flags_locked() & _STOPPED:
+            return None
+        if self.default_outcome is not None:
+            return self.default_outcome
+        outcomes = set(results.values())
+        if len(outcomes) == 1 and self.join == "all":
+            return outcomes.pop()
+        return None
+
+    def end(self, data=None):
+        pass
+
+    def _for_running(self, method, *args):
+        with self._phase_changed:
+            running = list(self._running)
+        for child in running:
+            getattr(child, method)(*args)
+
+    def pause_in(self, data=None):
+        for child in self._children_paused(False):
+            child._pause_in(data)
+
+    def pause_out(self, data=None):
+        for child in self._children_paused(True):
+            child._pause_out(data)
+
+    def _children_paused(self, paused):
+        with self._phase_changed:
+            running = list(self._running)
+        return [child for child in running if child._will_pause() == paused]
+
+    def _abort(self, data=None):
+        AbstractState._abort(self, data)
+        if not self._owns_token():
+            self._for_running("_abort", data)
+
+    def _time_out(self):
+        self._for_running("_preempt", None, 0)
+
+    def _preempt(self, data=None, timeout=None):
+        self._stop(PREEMPTED)
+        # every child gets the signal before we wait on any of them
+        if not self._owns_token():
+            self._for_running("_preempt", data, 0)
+        return self._wait_quiescent(timeout)
+
+
+class _AsyncRunner(object):
+    # shared by AsyncState and AsyncStateMachine, which declare the slots
+    __slots__ = ()
+    _steppable = False
+
+    def _run(self, data=None):
+        import asyncio
+
+        if self._owns_token():
+            return asyncio.run(self._run_async(data))
+        # a stop of the hierarchy above has to reach our event loop
+        self._token.watch(self._interrupt)
+        try:
+            return asyncio.run(self._run_async(data))
+        finally:
+            self._token.unwatch(self._interrupt)
+
+    def _step(self, data=None):
+        # an event loop cannot be stepped from outside, a parent's step runs it to completion
+        return self._run(data)
+
+    async def _run_async(self, data=None):
+        import asyncio
+
+        self.reset()
+        if self._token.flags & _STOPPED:
+            return _stopped_outcome(self._token.flags)
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.current_task()
+        self._resumed = asyncio.Event()
+        self._resumed.set()
+        if self.timeout is not None or self.watchdog is not None:
+            self._arm()
+        outcome = None
+        try:
+            self._set_phase(Phase.BEGINNING)
+            await self._call_hook_async(self.begin, Profiler.BEGIN, data)
+            self._set_phase(Phase.EXECUTING)
+            flags = self._get_flags()
+            while not (flags & _STOPPED or not outcome is None):
+                if flags & PAUSED:
+                    await self._call_hook_async(self.idle, Profiler.IDLE, data)
+                else:
+                    outcome = await self._call_hook_async(self.execute, Profiler.EXECUTE, data)
+                flags = self._get_flags()
+        except asyncio.CancelledError:
+            # only swallow the cancellation we requested through _preempt/_abort/timeouts
+            if not self._get_flags() & _STOPPED:
+                raise
+            self._task.uncancel()
+        finally:
+            if self._timer is not None:
+                self._disarm()
+            self._set_phase(Phase.IDLE)
+            self._task = None
+        flags = self._get_flags()
+        if flags & (ABORTED | PREEMPTED):
+            return _stopped_outcome(flags)
+        self._set_phase(Phase.ENDING)
+        try:
+            await self._call_hook_async(self.end, Profiler.END, data)
+        finally:
+            self._set_phase(Phase.IDLE)
+        return "__timeout__" if outcome is None else outcome
+
+    async def _call_hook_async(self, hook, phase, data):
+        # wall time, including what the hook spends awaiting
+        profiler = self._profiler
+        if profiler is None:
+            return await hook(data)
+        start = perf_counter_ns()
+        try:
+            return await hook(data)
+        finally:
+            profiler.record(self, phase, perf_counter_ns() - start)
+
+    def _call_in_loop(self, callback):
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return callback()
+        import asyncio
+
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            return callback()
+        loop.call_soon_threadsafe(callback)
+
+    def _cancel(self):
+        import asyncio
+
+        task = self._task
+        if task is not None and task is not asyncio.current_task() and self._get_phase() != Phase.ENDING:
+            task.cancel()
+
+    def _pause_in(self, data=None):
+        self._set_flag(PAUSED)
+        self.pause_in(data)
+        if self._resumed is not None:
+            self._call_in_loop(self._resumed.clear)
+
+    def _pause_out(self, data=None):
+        self.pause_out(data)
+        self._set_flag(PAUSED, False)
+        if self._resumed is not None:
+            self._call_in_loop(self._resumed.set)
+
+    def _abort(self, data=None):
+        self._stop(ABORTED)
+        self._call_in_loop(self._cancel)
+
+    def _preempt(self, data=None, timeout=None):
+        # never blocks: the event loop that would have to make progress may be the caller's
+        self._stop(PREEMPTED)
+        self._call_in_loop(self._cancel)
+        return True
+
+    def _interrupt(self, flag):
+        self._call_in_loop(self._cancel)
+
+    def _time_out(self):
+        self._interrupt(TIMED_OUT)
+
+    async def idle(self, data=None):
+        await self._resumed.wait()
+
+    def pause_in(self, data=None):
+        pass
+
+    def pause_out(self, data=None):
+        pass
+
+
+class AsyncState(_AsyncRunner, AbstractState):
+    __slots__ = ("_loop", "_task", "_resumed")
+
+    def __init__(self, name, outcomes=[]):
+        AbstractState.__init__(self, name, outcomes)
+        self._loop = None
+        self._task = None
+        self._resumed = None
+
+    async def begin(self, data=None):
+        raise NotImplementedError
+
+    async def execute(self, data=None):
+        raise NotImplementedError
+
+    async def end(self, data=None):
+        raise NotImplementedError
+
+
+class AsyncStateMachine(_AsyncRunner, StateMachine):
+    __slots__ = ("_loop", "_task", "_resumed")
+
+    def __init__(self, name, outcomes=[], starting_data=None):
+        StateMachine.__init__(self, name, outcomes, starting_data)
+        self._loop = None
+        self._task = None
+        self._resumed = None
+
+    async def begin(self, data=None):
+        StateMachine.begin(self, data)
+
+    async def execute(self, data=None):
+        import asyncio
+
+        outcome = None
+        while not (outcome in self._outcome_set or self._get_flags() & _STOPPED):
+            state = self.current_state
+            if isinstance(state, _AsyncRunner):
+                outcome = await state._run_async(data)
+            else:
+                # blocking states keep their own thread, off the event loop
+                outcome = await asyncio.to_thread(state._run, data)
+            outcome = self._transition(outcome, data)
+            if outcome == "__aborted__":
+                return outcome
+        return outcome
+
+    async def end(self, data=None):
+        pass
+
+    def pause_in(self, data=None):
+        StateMachine.pause_in(self, data)
+
+    def pause_out(self, data=None):
+        StateMachine.pause_out(self, data)
+
+    def _preempt(self, data=None, timeout=None):
+        self._stop(PREEMPTED)
+        self._call_in_loop(self._preempt_current)
+        return True
+
+    def _interrupt(self, flag):
+        self._call_in_loop(self._preempt_current)
+
+    def _preempt_current(self):
+        # the running child shares our task, so cancelling it once is enough
+        if self._get_phase() == Phase.EXECUTING:
+            self.current_state._preempt(None, 0)
+        else:
+            self._cancel()
+
+
 class TransitionError(Exception):
     pass
+
+
+class PreemptTimeout(Exception):
+    def __init__(self, state, timeout):
+        Exception.__init__(self, "state %s did not yield within %s s" % (state.name, timeout))
+        self.state = state
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+import numpy as np
+from state_machine import LazyState, TransitionError
+
+# encoding of the per-state target tables: >= 0 is a state index, STAY keeps the
+# instance where it is, and EXIT - k finishes the instance with machine outcome k
+STAY = -1
+EXIT = -2
+INVALID = np.iinfo(np.int32).min
+
+
+class BatchStateMachine(object):
+    def __init__(self, definition):
+        definition.compile()
+        self.definition = definition
+        initial = definition.initial_state
+        self.states = [initial] + [state for state in definition.states.values() if state is not initial]
+        self.outcomes = list(definition.outcomes)
+        index = dict((state, i) for i, state in enumerate(self.states))
+        exit_codes = dict((outcome, i) for i, outcome in enumerate(self.outcomes))
+        self._codes = []
+        self._targets = []
+        for state in self.states:
+            if not all(isinstance(target, str) for target in definition.transitions[state.name].values()):
+                raise TransitionError("state %s: guarded transitions are not supported in batches" % state.name)
+            route = definition._routes[state]
+            targets = np.full(len(state.outcomes) + 1, STAY, dtype=np.int32)
+            for i, outcome in enumerate(state.outcomes):
+                if outcome not in route:
+                    targets[i] = INVALID
+                elif route[outcome] is None:
+                    targets[i] = EXIT - exit_codes[outcome]
+                else:
+                    targets[i] = index[route[outcome]]
+            self._codes.append(dict((outcome, i) for i, outcome in enumerate(state.outcomes)))
+            self._targets.append(targets)
+
+    def run(self, data_batch, size=None, max_steps=None):
+        if size is None:
+            size = _batch_size(data_batch)
+        current = np.zeros(size, dtype=np.int32)
+        result = np.full(size, -1, dtype=np.int32)
+        entering = np.ones(size, dtype=bool)
+        steps = 0
+        active = np.arange(size)
+        while len(active) and (max_steps is None or steps < max_steps):
+            # group the active instances by current state, one hook call per group
+            order = active[np.argsort(current[active], kind="stable")]
+            groups = np.unique(current[order], return_index=True)
+            bounds = list(groups[1]) + [len(order)]
+            for k, s in enumerate(groups[0]):
+                self._step_state(int(s), order[bounds[k] : bounds[k + 1]], data_batch, current, result, entering)
+            active = np.flatnonzero(result < 0)
+            steps += 1
+        outcomes = np.empty(size, dtype=object)
+        finished = result >= 0
+        outcomes[finished] = np.array(self.outcomes, dtype=object)[result[finished]]
+        return outcomes
+
+    def _step_state(self, s, rows, data_batch, current, result, entering):
+        state = self.states[s]
+        if type(state) is LazyState:
+            state = state.state or state.build()
+        beginning = rows[entering[rows]]
+        if len(beginning):
+            self._call(state, "begin", data_batch, beginning)
+        codes = self._call(state, "execute", data_batch, rows, self._codes[s])
+        targets = self._targets[s][codes]
+        if (targets == INVALID).any():
+            raise TransitionError("outcome neither in state transitions nor in Statemachine outcomes")
+        leaving = targets != STAY
+        entering[rows] = leaving
+        if leaving.any():
+            self._call(state, "end", data_batch, rows[leaving])
+            moved = targets >= 0
+            current[rows[moved]] = targets[moved]
+            exited = targets <= EXIT
+            result[rows[exited]] = EXIT - targets[exited]
+
+    def _call(self, state, hook, data_batch, rows, codes=None):
+        batch = _select(data_batch, rows)
+        batch_hook = getattr(state, hook + "_batch", None)
+        if batch_hook is not None:
+            returned = batch_hook(batch)
+        else:
+            # states without a vectorized hook fall back to one call per instance
+            returned = [getattr(state, hook)(item) for item in _items(batch, len(rows))]
+        _write_back(data_batch, rows, batch)
+        if codes is None:
+            return None
+        if isinstance(returned, np.ndarray) and returned.dtype.kind in "iu":
+            return returned
+        try:
+            outcomes = (STAY if outcome is None else codes[outcome] for outcome in returned)
+            return np.fromiter(outcomes, np.int32, len(rows))
+        except KeyError:
+            raise TransitionError("outcome neither in state transitions nor in Statemachine outcomes")
+
+
+def _batch_size(data_batch):
+    if isinstance(data_batch, dict):
+        return len(next(iter(data_batch.values())))
+    return len(data_batch)
+
+
+def _select(data_batch, rows):
+    if data_batch is None:
+        return None
+    if isinstance(data_batch, np.ndarray):
+        return data_batch[rows]
+    if isinstance(data_batch, dict):
+        return dict((key, column[rows]) for key, column in data_batch.items())
+    return [data_batch[i] for i in rows]
+
+
+def _write_back(data_batch, rows, batch):
+    if isinstance(data_batch, np.ndarray):
+        data_batch[rows] = batch
+    elif isinstance(data_batch, dict):
+        for key, column in data_batch.items():
+            column[rows] = batch[key]
+
+
+def _items(batch, size):
+    if batch is None:
+        return [None] * size
+    if isinstance(batch, dict):
+        return [dict((key, column[i]) for key, column in batch.items()) for i in range(size)]
+    return batch
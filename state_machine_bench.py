@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+import argparse
+import gc
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from threading import Thread
+from time import perf_counter_ns
+from state_machine import AbstractState, InlineDispatcher, LazyState, MonitoredState, QueueDispatcher, StateMachine
+
+SIZES = (10, 100, 1000, 10000, 100000)
+DEPTHS = (1, 8, 32, 128)
+
+
+class NoopState(AbstractState):
+    def __init__(self, name, outcomes=[], execute_iterations=1):
+        AbstractState.__init__(self, name, outcomes)
+        self.execute_iterations = execute_iterations
+        self.executed = 0
+
+    def begin(self, data=None):
+        self.executed = 0
+
+    def execute(self, data=None):
+        self.executed += 1
+        return self.outcomes[0] if self.executed >= self.execute_iterations else None
+
+    def end(self, data=None):
+        pass
+
+    def pause_in(self, data=None):
+        pass
+
+    def pause_out(self, data=None):
+        pass
+
+
+class NoopMonitoredState(MonitoredState):
+    def __init__(self, name, event_cb, outcomes=[], dispatcher=None, execute_iterations=1):
+        MonitoredState.__init__(self, name, event_cb, outcomes, dispatcher)
+        self.execute_iterations = execute_iterations
+        self.executed = 0
+
+    begin = NoopState.begin
+    execute = NoopState.execute
+    end = NoopState.end
+
+
+class SpinState(NoopState):
+    # stamps the first iteration after stamp is cleared, so latencies are taken from the executing thread
+    def __init__(self, name):
+        NoopState.__init__(self, name, ["exit"], execute_iterations=1 << 62)
+        self.stamp = 0
+
+    def execute(self, data=None):
+        if not self.stamp:
+            self.stamp = perf_counter_ns()
+        return NoopState.execute(self, data)
+
+
+def build_ring(size):
+    sm = StateMachine("ring", ["exit"])
+    for i in range(size):
+        last = i == size - 1
+        state = NoopState("s%d" % i, ["exit" if last else "next"])
+        sm.add_state(state, {} if last else {"next": "s%d" % (i + 1)}, initial=i == 0)
+    return sm.compile()
+
+
+def build_nested(depth, leaf=None):
+    sm = StateMachine("level0", ["exit"])
+    sm.add_state(NoopState("leaf", ["exit"]) if leaf is None else leaf, {}, initial=True)
+    for i in range(1, depth):
+        parent = StateMachine("level%d" % i, ["exit"])
+        parent.add_state(sm, {}, initial=True)
+        sm = parent
+    return sm.compile()
+
+
+def result(name, value, unit, **params):
+    return {"name": name, "params": params, "value": value, "unit": unit}
+
+
+def bench_run_iteration(iterations):
+    state = NoopState("noop", ["exit"], execute_iterations=iterations)
+    start = perf_counter_ns()
+    state._run()
+    return [result("run_iteration", (perf_counter_ns() - start) / iterations, "ns/iteration", iterations=iterations)]
+
+
+def bench_transitions(sizes, min_transitions):
+    results = []
+    for size in sizes:
+        sm = build_ring(size)
+        runs = max(1, min_transitions // size)
+        start = perf_counter_ns()
+        for i in range(runs):
+            sm._run()
+        elapsed = perf_counter_ns() - start
+        results.append(result("transition", elapsed / (runs * size), "ns/transition", states=size))
+        del sm
+        gc.collect()
+    return results
+
+
+def bench_nesting(depths, runs):
+    results = []
+    for depth in depths:
+        for flat in (False, True):
+            sm = build_nested(depth)
+            if flat:
+                sm.flatten()
+            start = perf_counter_ns()
+            for i in range(runs):
+                sm._run()
+            elapsed = (perf_counter_ns() - start) / runs
+            results.append(result("nested_run", elapsed, "ns/run", depth=depth, flat=flat))
+    return results
+
+
+def bench_step(machines, frames):
+    # host-driven stepping: every frame steps each machine once, a finished machine starts over
+    ring = [build_ring(8) for i in range(machines)]
+    start = perf_counter_ns()
+    for frame in range(frames):
+        for sm in ring:
+            sm.step()
+    elapsed = perf_counter_ns() - start
+    return [result("step", elapsed / (machines * frames), "ns/step", machines=machines)]
+
+
+def bench_dispatch(iterations):
+    events = []
+    results = []
+    plain = NoopState("plain", ["exit"], execute_iterations=iterations)
+    start = perf_counter_ns()
+    plain._run()
+    baseline = (perf_counter_ns() - start) / iterations
+    dispatchers = (
+        ("inline", InlineDispatcher()),
+        ("queue", QueueDispatcher(maxsize=iterations + 16)),
+        ("queue_coalesce", QueueDispatcher(policy="coalesce")),
+    )
+    for name, dispatcher in dispatchers:
+        state = NoopMonitoredState("monitored", events.append, ["exit"], dispatcher, iterations)
+        start = perf_counter_ns()
+        state._run()
+        elapsed = (perf_counter_ns() - start) / iterations
+        dispatcher.flush()
+        dispatcher.close()
+        events.clear()
+        results.append(result("dispatch_overhead", elapsed - baseline, "ns/event", dispatcher=name))
+    return results
+
+
+def measure_latency(state, signal, repeat, leaf=None):
+    leaf = state if leaf is None else leaf
+    samples = []
+    for i in range(repeat):
+        execution = Thread(target=state._run)
+        execution.start()
+        while not leaf.is_executing():
+            time.sleep(0.0001)
+        time.sleep(0.001)
+        samples.append(signal(state))
+        state._preempt()
+        execution.join()
+    return samples
+
+
+def preempt_latency(state):
+    start = perf_counter_ns()
+    state._preempt()
+    return perf_counter_ns() - start
+
+
+def resume_latency(state):
+    state._pause_in()
+    time.sleep(0.002)
+    state.stamp = 0
+    start = perf_counter_ns()
+    state._pause_out()
+    while not state.stamp:
+        time.sleep(0.0001)
+    return state.stamp - start
+
+
+def bench_latencies(repeat):
+    results = []
+    for name, signal in (("preempt_latency", preempt_latency), ("resume_latency", resume_latency)):
+        samples = measure_latency(SpinState("spin"), signal, repeat)
+        results.append(result(name, statistics.median(samples), "ns", statistic="median", repeat=repeat))
+        results.append(result(name, max(samples), "ns", statistic="max", repeat=repeat))
+    return results
+
+
+def bench_nested_preempt(depths, repeat):
+    results = []
+    for depth in depths:
+        leaf = SpinState("spin")
+        samples = measure_latency(build_nested(depth, leaf), preempt_latency, repeat, leaf)
+        results.append(result("nested_preempt_latency", statistics.median(samples), "ns", depth=depth, repeat=repeat))
+    return results
+
+
+def bench_memory(sizes):
+    results = []
+    for size in sizes:
+        gc.collect()
+        tracemalloc.start()
+        states = [NoopState("s%d" % i, ["exit"]) for i in range(size)]
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results.append(result("memory_per_state", current / size, "bytes/state", states=size, lazy=False))
+        del states
+        tracemalloc.start()
+        states = [LazyState("s%d" % i, NoopState, ["exit"], args=("s%d" % i, ["exit"])) for i in range(size)]
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results.append(result("memory_per_state", current / size, "bytes/state", states=size, lazy=True))
+        del states
+    return results
+
+
+def metadata():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "commit": commit,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the state machine engine's own overhead")
+    parser.add_argument("--quick", action="store_true", help="small sizes and few repetitions")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args(argv)
+    sizes = SIZES[:3] if args.quick else SIZES
+    depths = DEPTHS[:2] if args.quick else DEPTHS
+    scale = 1 if args.quick else 10
+    results = []
+    results += bench_run_iteration(10000 * scale)
+    results += bench_transitions(sizes, 10000 * scale)
+    results += bench_nesting(depths, 100 * scale)
+    results += bench_step(1000, 10 * scale)
+    results += bench_dispatch(2000 * scale)
+    results += bench_latencies(5 * scale)
+    results += bench_nested_preempt(depths, 5 * scale)
+    results += bench_memory(sizes)
+    report = json.dumps({"meta": metadata(), "results": results}, indent=1)
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+import hashlib
+import marshal
+import os
+import struct
+import zlib
+from state_machine import Guard, LazyState, StateMachine, when
+
+# a definition names registered classes and their transitions, in YAML, JSON or TOML:
+#   name: mission
+#   outcomes: [done]
+#   initial: fetch
+#   states:
+#     fetch: {class: Fetch, outcomes: [ok, retry], transitions: {ok: work, retry: fetch}, lazy: true}
+#     work: {class: Work, args: [3], kwargs: {verbose: true}, timeout: 2.0, transitions: {__timeout__: fetch}}
+#     check: {class: Check, outcomes: [ok], transitions: {ok: [{target: charge, when: [battery, <, 20]}, work]}}
+# a state with its own states key is a nested machine, every other state is built as
+# cls(name, *args, outcomes=outcomes, **kwargs) where outcomes is only passed when given;
+# a transition is a target name or a list of guarded branches {target, when: [name, op, value], priority}
+_MACHINE_KEYS = frozenset(("name", "outcomes", "initial", "states", "lazy", "lazy_capacity", "flatten"))
+_STATE_KEYS = frozenset(("class", "args", "kwargs", "outcomes", "transitions", "lazy", "timeout", "watchdog", "rate"))
+_NESTED_KEYS = (_MACHINE_KEYS - {"name"}) | frozenset(("transitions", "timeout", "watchdog", "rate"))
+_GUARD_KEYS = frozenset(("target", "when", "priority"))
+_FORMATS = {".json": "json", ".toml": "toml", ".yaml": "yaml", ".yml": "yaml"}
+
+
+class ClassRegistry(object):
+    def __init__(self):
+        self._classes = dict()
+
+    def register(self, cls=None, name=None):
+        # register(cls), register(cls, "Name"), or as a @register / @register(name="Name") decorator
+        if cls is None:
+            return lambda cls: self.register(cls, name)
+        self._classes[cls.__name__ if name is None else name] = cls
+        return cls
+
+    def get(self, name):
+        try:
+            return self._classes[name]
+        except KeyError:
+            raise DefinitionError("state class %s is not registered" % name)
+
+    def __contains__(self, name):
+        return name in self._classes
+
+    def __len__(self):
+        return len(self._classes)
+
+
+default_registry = ClassRegistry()
+register = default_registry.register
+
+
+class DefinitionCache(object):
+    # one file per definition, named by the hash of its format and content:
+    # header, then the zlib compressed marshal of the compiled plan
+    _header = struct.Struct("<4sBBI")
+    _magic = b"SMDC"
+    _version = 1
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, content, kind):
+        digest = hashlib.blake2b(kind.encode() + b"\0" + content, digest_size=16).hexdigest()
+        return os.path.join(self.directory, digest + ".smd")
+
+    def get(self, content, kind):
+        try:
+            with open(self.path(content, kind), "rb") as f:
+                cached = f.read()
+        except FileNotFoundError:
+            return None
+        if len(cached) < self._header.size:
+            return None
+        magic, version, marshal_version, crc = self._header.unpack_from(cached)
+        payload = cached[self._header.size :]
+        # stale or torn files are ignored, the definition is compiled again and the file rewritten
+        if magic != self._magic or version != self._version or marshal_version != marshal.version:
+            return None
+        if zlib.crc32(payload) != crc:
+            return None
+        return marshal.loads(zlib.decompress(payload))
+
+    def put(self, content, kind, plan):
+        try:
+            payload = zlib.compress(marshal.dumps(plan, marshal.version))
+        except ValueError:
+            return False  # arguments marshal cannot store (YAML dates for instance) leave the definition uncached
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(content, kind)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            f.write(self._header.pack(self._magic, self._version, marshal.version, zlib.crc32(payload)) + payload)
+        os.replace(tmp_path, path)
+        return True
+
+
+def parse(content, kind):
+    if kind == "json":
+        import json
+
+        return json.loads(content)
+    if kind == "toml":
+        try:
+            import tomllib
+        except ImportError:
+            import tomli as tomllib
+
+        return tomllib.loads(content.decode())
+    if kind == "yaml":
+        import yaml
+
+        return yaml.safe_load(content)
+    raise DefinitionError("unknown definition format %s" % kind)
+
+
+def compile_definition(definition, name=None, lazy=False):
+    # checks the structure and returns the plan, plain builtins only so it can be cached;
+    # the graph itself is checked by StateMachine.compile() when the plan is built
+    if not isinstance(definition, dict):
+        raise DefinitionError("machine %s: definition must be a mapping" % name)
+    name = definition.get("name", name)
+    if name is None:
+        raise DefinitionError("machine definition without a name")
+    _check_keys(definition, _MACHINE_KEYS, name)
+    states = definition.get("states")
+    if not isinstance(states, dict) or not states:
+        raise DefinitionError("machine %s has no states" % name)
+    lazy = definition.get("lazy", lazy)
+    initial = definition.get("initial", next(iter(states)))
+    if initial not in states:
+        raise DefinitionError("machine %s: initial state %s is not defined" % (name, initial))
+    return {
+        "name": name,
+        "outcomes": _list(definition.get("outcomes", []), "outcomes", name),
+        "initial": initial,
+        "lazy_capacity": definition.get("lazy_capacity"),
+        "flatten": bool(definition.get("flatten", False)),
+        "states": [_compile_state(name, state_name, spec, lazy) for state_name, spec in states.items()],
+    }
+
+
+def _compile_state(machine, name, spec, lazy):
+    where = "%s.%s" % (machine, name)
+    if not isinstance(spec, dict):
+        raise DefinitionError("state %s: definition must be a mapping" % where)
+    transitions = spec.get("transitions", {})
+    if not isinstance(transitions, dict):
+        raise DefinitionError("state %s: transitions must be a mapping" % where)
+    rate = spec.get("rate")
+    plan = {
+        "name": name,
+        "transitions": dict((outcome, _compile_transition(where, target)) for outcome, target in transitions.items()),
+        "timeout": spec.get("timeout"),
+        "watchdog": spec.get("watchdog"),
+        "rate": None if rate is None else _list(rate if isinstance(rate, list) else [rate], "rate", where),
+    }
+    if "states" in spec:
+        _check_keys(spec, _NESTED_KEYS, where)
+        nested = dict((key, value) for key, value in spec.items() if key in _MACHINE_KEYS)
+        plan["machine"] = compile_definition(nested, name, lazy)
+        return plan
+    _check_keys(spec, _STATE_KEYS, where)
+    if "class" not in spec:
+        raise DefinitionError("state %s has neither a class nor states" % where)
+    outcomes = spec.get("outcomes")
+    plan["class"] = spec["class"]
+    plan["args"] = _list(spec.get("args", []), "args", where)
+    plan["kwargs"] = dict(spec.get("kwargs", {}))
+    plan["outcomes"] = None if outcomes is None else _list(outcomes, "outcomes", where)
+    plan["lazy"] = bool(spec.get("lazy", lazy))
+    if plan["lazy"] and outcomes is None:
+        raise DefinitionError("lazy state %s needs its outcomes in the definition" % where)
+    return plan
+
+
+def _compile_transition(where, target):
+    if isinstance(target, str):
+        return target
+    branches = []
+    for branch in target if isinstance(target, list) else [target]:
+        if isinstance(branch, str):
+            branches.append([branch, None, 0])
+            continue
+        if not isinstance(branch, dict) or not isinstance(branch.get("target"), str):
+            raise DefinitionError("state %s: a guarded transition needs a target" % where)
+        _check_keys(branch, _GUARD_KEYS, where)
+        condition = branch.get("when")
+        if condition is not None:
+            condition = _list(condition, "when", where)
+            try:
+                when(*condition)
+            except (TypeError, ValueError):
+                raise DefinitionError("state %s: guard %s is not [name, operator, value]" % (where, condition))
+        branches.append([branch["target"], condition, branch.get("priority", 0)])
+    return branches
+
+
+def _check_keys(spec, allowed, where):
+    unknown = [key for key in spec if key not in allowed]
+    if unknown:
+        raise DefinitionError("%s: unknown keys %s" % (where, ", ".join(map(str, unknown))))
+
+
+def _list(value, key, where):
+    if not isinstance(value, list):
+        raise DefinitionError("%s: %s must be a list" % (where, key))
+    return list(value)
+
+
+def build(plan, registry=None):
+    # the graph is checked on every build, even from a cached plan: state outcomes come from the
+    # registered classes and those may have changed since the plan was cached
+    machine = _build_machine(plan, default_registry if registry is None else registry)
+    return machine.compile()
+
+
+def _build_machine(plan, registry):
+    machine = StateMachine(plan["name"], plan["outcomes"])
+    machine.lazy_capacity = plan["lazy_capacity"]
+    for spec in plan["states"]:
+        transitions = dict((outcome, _build_transition(target)) for outcome, target in spec["transitions"].items())
+        machine.add_state(_build_state(spec, registry), transitions, initial=spec["name"] == plan["initial"])
+    # compile() runs once build() has the whole tree, flatten() would compile every level again
+    machine._flat = plan["flatten"]
+    return machine
+
+
+def _build_transition(target):
+    if isinstance(target, str):
+        return target
+    return [
+        Guard(name, None if condition is None else when(*condition), priority) for name, condition, priority in target
+    ]
+
+
+def _build_state(spec, registry):
+    if "machine" in spec:
+        state = _build_machine(spec["machine"], registry)
+    else:
+        cls = registry.get(spec["class"])
+        kwargs = dict(spec["kwargs"])
+        if spec["outcomes"] is not None:
+            kwargs["outcomes"] = spec["outcomes"]
+        if spec["lazy"]:
+            state = LazyState(spec["name"], cls, spec["outcomes"], (spec["name"],) + tuple(spec["args"]), kwargs)
+        else:
+            state = cls(spec["name"], *spec["args"], **kwargs)
+    if spec["rate"] is not None:
+        state.set_rate(*spec["rate"])
+    if spec["timeout"] is not None or spec["watchdog"] is not None:
+        state.set_timeout(spec["timeout"], spec["watchdog"])
+    return state
+
+
+def loads(content, kind, registry=None, cache_dir=None):
+    if isinstance(content, str):
+        content = content.encode()
+    cache = None if cache_dir is None else DefinitionCache(cache_dir)
+    plan = None if cache is None else cache.get(content, kind)
+    if plan is not None:
+        return build(plan, registry)
+    plan = compile_definition(parse(content, kind))
+    machine = build(plan, registry)
+    if cache is not None:
+        cache.put(content, kind, plan)
+    return machine
+
+
+def load(path, registry=None, cache_dir=None):
+    kind = _FORMATS.get(os.path.splitext(path)[1].lower())
+    if kind is None:
+        raise DefinitionError("%s: unknown definition format" % path)
+    with open(path, "rb") as f:
+        content = f.read()
+    return loads(content, kind, registry, cache_dir)
+
+
+class DefinitionError(Exception):
+    pass
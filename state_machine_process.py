@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+import multiprocessing
+import os
+import traceback
+from multiprocessing import resource_tracker, shared_memory
+from queue import Queue
+from threading import Lock, Thread
+from state_machine import AbstractState, PassingData, Phase, PAUSED, PREEMPTED, ABORTED, TIMED_OUT, _stopped_outcome
+
+_STOPPED = PREEMPTED | ABORTED | TIMED_OUT
+
+
+class ProcessWorker(object):
+    def __init__(self, context):
+        # the control block lives in shared memory, the parent writes it and the
+        # worker's watcher thread forwards it to the running state
+        self.flags = context.RawValue("i", 0)
+        self.changed = context.Event()
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(child_connection, self.flags, self.changed), daemon=True
+        )
+        self.process.start()
+        child_connection.close()
+        self.broken = False
+
+    def signal(self, flags):
+        self.flags.value = flags
+        self.changed.set()
+
+    def run(self, factory, args, data):
+        payload, blocks = _pack_data(data)
+        try:
+            self.connection.send((factory, args, payload))
+            reply = self.connection.recv()
+        except (EOFError, OSError):
+            # the process died under the state (os._exit, a signal, out of memory), the pool replaces it
+            self.broken = True
+            self.process.join(1.0)
+            raise ProcessStateError("worker process %d exited with code %s" % (self.process.pid, self.process.exitcode))
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+        if reply[0] == "error":
+            raise ProcessStateError(reply[1])
+        outcome, changes = reply[1], reply[2]
+        if isinstance(data, PassingData):
+            _unpack_changes(data, changes)
+        return outcome
+
+    def close(self):
+        if self.broken:
+            self.process.kill()
+        try:
+            self.connection.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join()
+        self.connection.close()
+
+
+class ProcessPool(object):
+    def __init__(self, processes=None, context=None):
+        self.context = multiprocessing.get_context(context)
+        # workers must share the parent's tracker: blocks are created on one side and unlinked on the other
+        resource_tracker.ensure_running()
+        self._workers = [ProcessWorker(self.context) for i in range(processes or os.cpu_count())]
+        self._lock = Lock()
+        self._idle = Queue()
+        for worker in self._workers:
+            self._idle.put(worker)
+
+    def acquire(self):
+        return self._idle.get()
+
+    def release(self, worker):
+        if worker.broken or not worker.process.is_alive():
+            # a dead worker would fail the next run on a broken pipe, a new one takes its place
+            worker.close()
+            with self._lock:
+                if worker not in self._workers:
+                    return  # the pool was closed meanwhile
+                replacement = ProcessWorker(self.context)
+                self._workers[self._workers.index(worker)] = replacement
+            worker = replacement
+        self._idle.put(worker)
+
+    def close(self):
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.close()
+
+
+_default_pool = None
+_default_pool_lock = Lock()
+
+
+def default_process_pool():
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ProcessPool()
+        return _default_pool
+
+
+class ProcessState(AbstractState):
+    # factory(*args) must be picklable and build the state (or sub-StateMachine)
+    # inside the worker; only PassingData changes are sent back to the parent
+    __slots__ = ("factory", "args", "pool", "_worker")
+    _steppable = False
+
+    def __init__(self, name, factory, outcomes=[], args=(), pool=None):
+        AbstractState.__init__(self, name, outcomes)
+        self.factory = factory
+        self.args = args
+        self.pool = pool
+        self._worker = None
+
+    def _run(self, data=None):
+        self.reset()
+        if self._token.flags & _STOPPED:
+            # the hierarchy was stopped while we were being entered, no worker is taken
+            return _stopped_outcome(self._token.flags)
+        pool = self.pool if self.pool is not None else default_process_pool()
+        worker = pool.acquire()
+        # stops of the whole hierarchy arrive through the token, not through _set_flag
+        self._token.watch(self._forward)
+        try:
+            with self._phase_changed:
+                self._worker = worker
+                self._phase = Phase.EXECUTING
+                worker.signal(self._get_flags_locked())
+            if self.timeout is not None or self.watchdog is not None:
+                self._arm()
+            outcome = worker.run(self.factory, self.args, data)
+            flags = self._get_flags()
+            if outcome == "__preempted__" and flags & TIMED_OUT and not flags & (PREEMPTED | ABORTED):
+                outcome = "__timeout__"
+            return outcome
+        finally:
+            self._disarm()
+            self._token.unwatch(self._forward)
+            with self._phase_changed:
+                self._worker = None
+                self._phase = Phase.IDLE
+                self._phase_changed.notify_all()
+            pool.release(worker)
+
+    def _step(self, data=None):
+        # the remote state runs its own loop, a parent's step waits for its result
+        return self._run(data)
+
+    def _set_flag(self, flag, value=True):
+        with self._phase_changed:
+            AbstractState._set_flag(self, flag, value)
+            self._forward()
+
+    def _forward(self, flag=None):
+        with self._phase_changed:
+            if self._worker is not None:
+                self._worker.signal(self._get_flags_locked())
+
+    def _is_quiescent(self):
+        # the remote state handles pause itself, here we only wait for the result
+        return self._phase == Phase.IDLE
+
+    def pause_in(self, data=None):
+        pass
+
+    def pause_out(self, data=None):
+        pass
+
+
+class ProcessStateError(Exception):
+    pass
+
+
+def _worker_main(connection, flags, changed):
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        factory, args, payload = task
+        blocks = []
+        data = None
+        try:
+            state = factory(*args)
+            data, versions = _unpack_data(payload, blocks)
+            done = []
+            watcher = Thread(target=_watch_flags, args=(state, flags, changed, done), daemon=True)
+            watcher.start()
+            outcome = state._run(data)
+            done.append(True)
+            changed.set()
+            watcher.join()
+            reply = ("ok", outcome, _pack_changes(data, versions))
+        except Exception:
+            reply = ("error", traceback.format_exc())
+        del data
+        for block in blocks:
+            try:
+                block.close()
+            except BufferError:
+                pass  # the state kept a view on it, the parent still unlinks the block
+        connection.send(reply)
+
+
+def _watch_flags(state, flags, changed, done):
+    # wait for _run to pass its reset() so forwarded flags are not cleared
+    with state._phase_changed:
+        while state._phase == Phase.IDLE and not done:
+            state._phase_changed.wait(0.01)
+    applied = 0
+    while not done:
+        changed.clear()
+        current = flags.value
+        try:
+            if current & PAUSED and not applied & PAUSED:
+                state._pause_in()
+            elif applied & PAUSED and not current & PAUSED:
+                state._pause_out()
+            if current & (PREEMPTED | TIMED_OUT) and not applied & (PREEMPTED | TIMED_OUT):
+                # the remote state only has to stop, the parent turns it into __timeout__
+                state._preempt(None, 0)
+            if current & ABORTED and not applied & ABORTED:
+                state._abort()
+        except Exception:
+            traceback.print_exc()
+        applied = current
+        changed.wait()
+
+
+def _is_buffer(value):
+    if hasattr(value, "__array_interface__"):
+        return getattr(value, "ndim", 0) > 0
+    return isinstance(value, (bytes, bytearray, memoryview))
+
+
+def _share(value):
+    # copies a buffer into a new shared memory block, described by (name, kind, dtype, shape, nbytes)
+    if hasattr(value, "__array_interface__") and not value.flags.c_contiguous:
+        value = value.copy()
+    view = memoryview(value).cast("B")
+    block = shared_memory.SharedMemory(create=True, size=max(len(view), 1))
+    block.buf[: len(view)] = view
+    if hasattr(value, "__array_interface__"):
+        descriptor = (block.name, "array", value.dtype.str, value.shape, len(view))
+    else:
+        descriptor = (block.name, type(value).__name__, None, None, len(view))
+    return descriptor, block
+
+
+def _attach(descriptor, blocks, copy=False):
+    name, kind, dtype, shape, nbytes = descriptor
+    block = shared_memory.SharedMemory(name=name)
+    blocks.append(block)
+    if kind == "array":
+        import numpy as np
+
+        array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        return array.copy() if copy else array
+    if kind == "bytearray":
+        return bytearray(block.buf[:nbytes])
+    return bytes(block.buf[:nbytes])
+
+
+def _pack_data(data):
+    if not isinstance(data, PassingData):
+        return ("object", data), []
+    values, versions = data.snapshot()
+    entries, blocks = {}, []
+    for name, value in values.items():
+        if _is_buffer(value):
+            descriptor, block = _share(value)
+            blocks.append(block)
+            entries[name] = ("shared", descriptor)
+        else:
+            entries[name] = ("object", value)
+    return ("passing_data", entries), blocks
+
+
+def _unpack_data(payload, blocks):
+    kind, content = payload
+    if kind == "object":
+        return content, None
+    data = PassingData()
+    for name, (entry_kind, value) in content.items():
+        data.set(name, _attach(value, blocks) if entry_kind == "shared" else value)
+    return data, dict((name, data.version(name)) for name in data.keys())
+
+
+def _pack_changes(data, versions):
+    if versions is None:
+        return {}
+    changes = {}
+    for name in data.keys():
+        if data.version(name) == versions.get(name, 0):
+            continue
+        value = data.get(name)
+        if _is_buffer(value):
+            # the parent copies the block out and unlinks it
+            descriptor, block = _share(value)
+            block.close()
+            changes[name] = ("shared", descriptor)
+        else:
+            changes[name] = ("object", value)
+    return changes
+
+
+def _unpack_changes(data, changes):
+    for name, (kind, value) in changes.items():
+        if kind == "shared":
+            blocks = []
+            data.set(name, _attach(value, blocks, copy=True))
+            for block in blocks:
+                block.close()
+                block.unlink()
+        else:
+            data.set(name, value)
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+import argparse
+import importlib
+import sys
+from state_machine import TransitionLog, replay
+
+
+def load_factory(spec):
+    module_name, _, function_name = spec.partition(":")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a transition log against a state machine definition")
+    parser.add_argument("log", help="transition log written by TransitionLog.dump_jsonl or dump_binary")
+    parser.add_argument("factory", help="module:function returning the StateMachine definition")
+    parser.add_argument("--machine", help="only replay records of this machine")
+    args = parser.parse_args(argv)
+    records = TransitionLog.load(args.log)
+    if args.machine is not None:
+        records = [record for record in records if record.machine == args.machine]
+    mismatches = replay(load_factory(args.factory)(), records)
+    for record, state, target in mismatches:
+        logged = "%s --%s--> %s" % (record.state, record.outcome, record.target)
+        expected = "%s --%s--> %s" % (state, record.outcome, target)
+        print("%d %s: logged %s, definition expects %s" % (record.timestamp_ns, record.machine, logged, expected))
+    print("%d records replayed, %d mismatches" % (len(records), len(mismatches)))
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
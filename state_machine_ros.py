@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# optional ROS integration, the core state_machine module does not depend on rospy
+import rospy
+from std_msgs.msg import String
+
+
+def event_publisher(topic, queue_size=10):
+    # event_cb for MonitoredState, publishes "<state>:<event>" strings
+    publisher = rospy.Publisher(topic, String, queue_size=queue_size)
+
+    def event_cb(event):
+        publisher.publish(String(data="%s:%s" % (getattr(event, "state", ""), event)))
+
+    return event_cb
+
+
+class StateControl(object):
+    # drives a running state from a String topic: pause, resume, preempt or abort
+    def __init__(self, state, topic, preempt_timeout=None):
+        self.state = state
+        self.preempt_timeout = preempt_timeout
+        self._subscriber = rospy.Subscriber(topic, String, self._on_command)
+
+    def _on_command(self, msg):
+        command = msg.data.strip()
+        if command == "pause":
+            self.state.pause(True)
+        elif command == "resume":
+            self.state.pause(False)
+        elif command == "preempt":
+            self.state._preempt(None, self.preempt_timeout)
+        elif command == "abort":
+            self.state._abort()
+        else:
+            rospy.logwarn("unknown state command %s", command)
+
+    def close(self):
+        self._subscriber.unregister()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+import os
+import time
+from heapq import heappop, heappush
+from itertools import count
+from threading import Condition, Lock, Thread, current_thread
+from state_machine import PREEMPTED, ABORTED, TIMED_OUT, default_scheduler
+
+_STOPPED = PREEMPTED | ABORTED | TIMED_OUT
+
+
+class Job(object):
+    # one run of a machine hosted by a Runtime
+    __slots__ = (
+        "runtime",
+        "machine",
+        "data",
+        "priority",
+        "outcome",
+        "exception",
+        "steps",
+        "_pass",
+        "_timer",
+        "_stop",
+        "_done",
+    )
+
+    def __init__(self, runtime, machine, data, priority):
+        self.runtime = runtime
+        self.machine = machine
+        self.data = data
+        self.priority = priority
+        self.outcome = None
+        self.exception = None
+        self.steps = 0
+        self._pass = 0.0
+        self._timer = None
+        self._stop = 0
+        self._done = False
+
+    def done(self):
+        with self.runtime._lock:
+            return self._done
+
+    def wait(self, timeout=None):
+        with self.runtime._lock:
+            return self.runtime._finished.wait_for(lambda: self._done, timeout)
+
+    def result(self, timeout=None):
+        if not self.wait(timeout):
+            raise TimeoutError("machine %s still running" % self.machine.name)
+        if self.exception is not None:
+            raise self.exception
+        return self.outcome
+
+    def _on_timer(self, entry):
+        self.runtime._wake(self, entry)
+
+
+class Runtime(object):
+    # hosts many machines on a fixed pool of worker threads: a worker takes the job with the smallest
+    # pass, steps its machine once and puts it back, so a state returning None gives up its worker.
+    # each step adds stride / priority to the pass, a job gets steps in proportion to its priority.
+    # states that cannot be stepped (async, process, concurrent regions) hold a worker until they finish
+    _stride = 1.0
+
+    def __init__(self, workers=None, quantum=16, idle_poll=0.1):
+        # a turn is at most quantum steps of one job, fewer once it has to wait or is stopped or paused;
+        # while paused with a blocking idle strategy a machine is looked at again every idle_poll seconds
+        self.quantum = quantum
+        self.idle_poll = idle_poll
+        self._lock = Lock()
+        self._ready = Condition(self._lock)
+        self._finished = Condition(self._lock)
+        self._heap = []
+        self._sequence = count()
+        self._jobs = {}
+        self._held = []
+        self._active = 0
+        self._pass = 0.0
+        self._paused = False
+        self._paused_machines = []
+        self._closed = False
+        self._workers = [
+            Thread(target=self._work, name="state_machine_runtime_%d" % i, daemon=True)
+            for i in range(workers or os.cpu_count())
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, machine, data=None, priority=1):
+        if priority <= 0:
+            raise ValueError("priority must be positive")
+        with self._lock:
+            if self._closed:
+                raise ValueError("runtime is closed")
+            if id(machine) in self._jobs:
+                raise ValueError("machine %s is already running" % machine.name)
+            job = Job(self, machine, data, priority)
+            self._jobs[id(machine)] = job
+            self._push(job)
+        return job
+
+    def __len__(self):
+        with self._lock:
+            return len(self._jobs)
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def wait(self, timeout=None):
+        with self._lock:
+            return self._finished.wait_for(lambda: not self._jobs, timeout)
+
+    def pause(self, pause):
+        # no machine is stepped once this returns, running ones get their pause_in/pause_out hooks
+        if pause:
+            own = 1 if current_thread() in self._workers else 0
+            with self._lock:
+                if self._paused:
+                    return True
+                self._paused = True
+                self._finished.wait_for(lambda: self._active == own)
+                jobs = list(self._jobs.values())
+            paused = []
+            for job in jobs:
+                if not job.machine.is_paused():
+                    job.machine._pause_in(job.data)
+                    paused.append(job)
+            with self._lock:
+                self._paused_machines = [job for job in paused if not job._done]
+            return True
+        with self._lock:
+            if not self._paused:
+                return False
+            jobs, self._paused_machines = self._paused_machines, []
+        for job in jobs:
+            job.machine._pause_out(job.data)
+        with self._lock:
+            self._paused = False
+            for job in self._held:
+                self._push(job)
+            self._held = []
+        return False
+
+    def is_paused(self):
+        with self._lock:
+            return self._paused
+
+    def preempt(self, machine=None):
+        # stopped machines are stepped even while paused, their next step ends the run
+        self._stop_jobs(machine, PREEMPTED)
+
+    def abort(self, machine=None):
+        self._stop_jobs(machine, ABORTED)
+
+    def _stop_jobs(self, machine, flag):
+        with self._lock:
+            if machine is None:
+                jobs = list(self._jobs.values())
+            else:
+                jobs = [self._jobs[id(machine)]] if id(machine) in self._jobs else []
+            for job in jobs:
+                job._stop |= flag
+        for job in jobs:
+            self._signal(job)
+            self._wake(job)
+
+    def _signal(self, job):
+        if job._stop & ABORTED:
+            job.machine._abort(job.data)
+        else:
+            job.machine._preempt(job.data, 0)
+
+    def close(self, timeout=None):
+        with self._lock:
+            self._closed = True
+        self.preempt()
+        if not self.wait(timeout):
+            return False
+        with self._lock:
+            self._ready.notify_all()
+        for worker in self._workers:
+            worker.join()
+        return True
+
+    def _push(self, job):
+        # a job coming back from a wait starts at the current pass instead of catching up in a burst
+        if job._pass < self._pass:
+            job._pass = self._pass
+        heappush(self._heap, (job._pass, next(self._sequence), job))
+        self._ready.notify()
+
+    def _wake(self, job, entry=None):
+        with self._lock:
+            if entry is None:
+                if job in self._held:
+                    self._held.remove(job)
+                    self._push(job)
+                    return
+                if job._timer is None:
+                    return  # queued or being stepped
+                default_scheduler().cancel(job._timer)
+            elif job._timer is not entry:
+                return
+            job._timer = None
+            self._push(job)
+
+    def _next(self):
+        while True:
+            while not self._heap:
+                if self._closed and not self._jobs:
+                    return None
+                self._ready.wait()
+            job_pass, sequence, job = heappop(self._heap)
+            if self._paused and not job.machine._get_flags() & _STOPPED:
+                self._held.append(job)
+                continue
+            self._pass = job_pass
+            self._active += 1
+            return job
+
+    def _work(self):
+        while True:
+            with self._lock:
+                job = self._next()
+            if job is None:
+                return
+            try:
+                self._turn(job)
+            finally:
+                with self._lock:
+                    self._active -= 1
+                    # pause() called from a worker waits for the others while still counting itself
+                    if self._paused:
+                        self._finished.notify_all()
+
+    def _turn(self, job):
+        machine = job.machine
+        steps = 0
+        try:
+            while True:
+                outcome = machine._step(job.data)
+                steps += 1
+                if outcome is not None or steps >= self.quantum or self._paused or job._stop:
+                    break
+                if machine._step_delay() != 0.0:
+                    break
+        except BaseException as exception:
+            job.steps += steps
+            self._finish(job, None, exception)
+            if not isinstance(exception, Exception):
+                raise
+            return
+        job.steps += steps
+        if outcome is not None:
+            self._finish(job, outcome)
+            return
+        if job._stop and not machine._get_flags() & _STOPPED:
+            # stopped before its first step, entering the machine cleared the flag
+            self._signal(job)
+        delay = machine._step_delay()
+        if delay is None:
+            delay = self.idle_poll
+        with self._lock:
+            job._pass += steps * self._stride / job.priority
+            # a stop that raced with the delay above must not wait for the timer
+            if delay > 0 and not job.machine._get_flags() & _STOPPED:
+                job._timer = default_scheduler().schedule(time.monotonic() + delay, job._on_timer)
+            else:
+                self._push(job)
+
+    def _finish(self, job, outcome, exception=None):
+        with self._lock:
+            job.outcome = outcome
+            job.exception = exception
+            job._done = True
+            del self._jobs[id(job.machine)]
+            if job in self._paused_machines:
+                self._paused_machines.remove(job)
+            self._finished.notify_all()
+            if self._closed and not self._jobs:
+                self._ready.notify_all()
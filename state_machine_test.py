@@ -1,11 +1,133 @@
 #!/usr/bin/env python3
-from state_machine import MonitoredState, PassingData, StateMachine, AbstractState, TransitionError
+from state_machine import MonitoredState, PassingData, StateMachine, AbstractState, TransitionError, Phase
+from state_machine import InlineDispatcher, QueueDispatcher, ThreadPoolDispatcher
+from state_machine import AsyncState, AsyncStateMachine, Profiler
+from state_machine import BackoffIdle, BlockingIdle, FixedIdle, Rate, ConcurrentState
+from concurrent.futures import ThreadPoolExecutor
+from state_machine import Checkpoint, CheckpointError, TransitionLog, TransitionRecord, replay
+from state_machine import PreemptTimeout, TimerScheduler, PAUSED, PREEMPTED, LazyState, LockedVariable, Guard, when
+import copy
+import pickle
+import shutil
+import threading
+import state_machine_replay
+import state_machine_bench
+import state_machine_loader
+import os
+import struct
+import subprocess
+import sys
+import tempfile
 import unittest
 import time
+import tracemalloc
 import asyncio
 from threading import Thread, Timer
 from multiprocessing import Process
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
+from state_machine_process import ProcessPool, ProcessState, ProcessStateError
+from state_machine_loader import ClassRegistry, DefinitionError
+from state_machine_runtime import Runtime
+
+try:
+    import numpy as np
+    from state_machine_batch import BatchStateMachine
+except ImportError:
+    np = None
+
+
+class TestPassingData(unittest.TestCase):
+    def test_attributes(self):
+        data = PassingData(a=1)
+        data.b = [1, 2]
+        assert data.a == 1 and data.b == [1, 2]
+        assert "b" in data and "c" not in data
+        assert data.get("c", 3) == 3
+        with self.assertRaises(AttributeError):
+            data.c
+
+    def test_copy(self):
+        data = PassingData(a=1, b=[1, 2])
+        data.a = 2
+        assert not hasattr(PassingData.__new__(PassingData), "a")
+        shallow = copy.copy(data)
+        assert shallow.a == 2 and shallow.b is data.b and shallow.version("a") == 2
+        deep = copy.deepcopy(data)
+        assert deep.b == [1, 2] and deep.b is not data.b
+        deep.c = 3
+        assert "c" not in data and deep.lock("c") is not data.lock("c")
+
+    def test_pickle(self):
+        data = pickle.loads(pickle.dumps(PassingData(a=1, b=[1, 2])))
+        assert data.a == 1 and data.b == [1, 2] and data.version("b") == 1
+        data.update("a", lambda value: value + 1)
+        assert data.a == 2
+
+    def test_no_copy(self):
+        data = PassingData()
+        value = [1, 2]
+        data.value = value
+        assert data.value is value
+
+    def test_versions(self):
+        data = PassingData()
+        assert data.version("a") == 0
+        data.a = 1
+        version = data.version("a")
+        assert not data.changed("a", version)
+        data.a = 2
+        assert data.changed("a", version)
+
+    def test_update(self):
+        data = PassingData(counter=0)
+
+        def increment():
+            for i in range(1000):
+                data.update("counter", lambda value: value + 1)
+
+        threads = [Thread(target=increment) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert data.counter == 4000
+        assert data.version("counter") == 4001
+
+    def test_copy_on_write(self):
+        # values are immutable by contract, update() replaces a list instead of changing it in place
+        data = PassingData(items=[1, 2])
+        held = data.items
+        values, versions = data.snapshot()
+        version = data.version("items")
+        assert data.update("items", lambda items: items + [3]) == [1, 2, 3]
+        assert data.changed("items", version)
+        assert held == [1, 2] and values["items"] == [1, 2]
+        assert data.items is not held
+
+    def test_snapshot(self):
+        data = PassingData(a=1)
+        values, versions = data.snapshot()
+        data.a = 2
+        assert values["a"] == 1 and versions["a"] == 1
+        with self.assertRaises(TypeError):
+            values["a"] = 3
+
+    def test_buffer_view(self):
+        data = PassingData(buffer=bytearray(b"abc"))
+        view = data.view("buffer")
+        assert view.readonly and bytes(view) == b"abc"
+        data.buffer[0] = ord("x")
+        assert bytes(view) == b"xbc"
+
+    @unittest.skipIf(np is None, "numpy not available")
+    def test_array_read_only(self):
+        array = np.zeros(4)
+        data = PassingData(array=array)
+        assert np.shares_memory(data.array, array)
+        with self.assertRaises(ValueError):
+            data.array[0] = 1
+        array[0] = 1
+        assert data.array[0] == 1
 
 
 class TestState(AbstractState):
@@ -164,6 +286,8 @@ class TestBasicStateMachine(unittest.TestCase):
         assert self.state3.mock.end.call_count == 1
 
     def test_pause_twice(self):
+        # long enough that both pauses land while test1 runs
+        self.state1.execute_iterations = 10
         execution = Thread(target=self.sm._run)
         execution.start()
         time.sleep(0.03)
@@ -178,7 +302,7 @@ class TestBasicStateMachine(unittest.TestCase):
         self.state1.mock.pause_out.assert_called()
         assert self.state1.mock.pause_out.call_count == 2
         self.state1.mock.execute.assert_called()
-        assert self.state1.mock.execute.call_count == self.iterations_num
+        assert self.state1.mock.execute.call_count == 10
         self.state1.mock.end.assert_called()
         assert self.state1.mock.end.call_count == 1
         self.state2.mock.begin.assert_called()
@@ -261,6 +385,196 @@ class TestBasicStateMachine(unittest.TestCase):
         self.state3.mock.end.assert_not_called()
 
 
+class TestPreemptWakeup(unittest.TestCase):
+    def setUp(self):
+        self.state = TestState("test1", ["exit"], execute_iterations=1000)
+
+    def test_preempt_returns_when_quiescent(self):
+        execution = Thread(target=self.state._run)
+        execution.start()
+        time.sleep(0.03)
+        assert self.state._preempt() is True
+        assert not self.state.is_executing()
+        execution.join()
+
+    def test_preempt_timeout_while_paused(self):
+        # a state blocked in a begin hook does not yield before the timeout
+        release = threading.Event()
+        state = TestState("test1", ["exit"], execute_iterations=1000)
+        state.mock.begin.side_effect = lambda *args: release.wait(5)
+        execution = Thread(target=state._run)
+        execution.start()
+        time.sleep(0.03)
+        start_time = time.time()
+        assert state._preempt(timeout=0.05) is False
+        assert time.time() - start_time < 0.5
+        release.set()
+        execution.join()
+        assert state._preempt(timeout=0.05) is True
+
+    def test_preempt_while_paused(self):
+        outcomes = []
+        execution = Thread(target=lambda: outcomes.append(self.state._run()))
+        execution.start()
+        time.sleep(0.03)
+        self.state._pause_in()
+        # the paused state leaves its run on the stop, preempt does not wait for a resume
+        assert self.state._preempt(timeout=1.0) is True
+        execution.join()
+        assert outcomes == ["__preempted__"]
+        assert self.state.preempt(timeout=None)
+
+
+class TestStateStatus(unittest.TestCase):
+    def test_status_snapshot(self):
+        state = TestState("test1", ["exit"], execute_iterations=1000)
+        assert state.status() == (Phase.IDLE, False, False, False)
+        execution = Thread(target=state._run)
+        execution.start()
+        time.sleep(0.03)
+        state._pause_in()
+        status = state.status()
+        assert status.phase == Phase.EXECUTING
+        assert status.paused and not status.preempted and not status.aborted
+        state._pause_out()
+        state._preempt()
+        execution.join()
+        assert state.status() == (Phase.IDLE, False, True, False)
+        state.reset()
+        assert state.status() == (Phase.IDLE, False, False, False)
+
+    def test_slots(self):
+        state = StateMachine("test_state_machine", ["exit"])
+        with self.assertRaises(AttributeError):
+            state.not_a_slot = 0
+
+
+class TestIdleStrategies(unittest.TestCase):
+    def setUp(self):
+        self.state = TestState("test1", ["exit"], execute_iterations=1000)
+
+    def pause_for(self, pause_time):
+        execution = Thread(target=self.state._run)
+        execution.start()
+        time.sleep(0.03)
+        self.state._pause_in()
+        time.sleep(pause_time)
+        executed = self.state.test_execute
+        start_time = time.time()
+        self.state._pause_out()
+        while self.state.test_execute == executed:
+            time.sleep(0.0001)
+        resume_time = time.time() - start_time
+        self.state._preempt()
+        execution.join()
+        return resume_time
+
+    def test_timeouts(self):
+        strategy = BackoffIdle(0.001, 0.004)
+        timeouts = [None]
+        for i in range(4):
+            timeouts.append(strategy.next_timeout(timeouts[-1]))
+        assert timeouts[1:] == [0.001, 0.002, 0.004, 0.004]
+        assert FixedIdle(0.5).next_timeout(0.5) == 0.5
+        assert BlockingIdle().next_timeout(None) is None
+
+    def test_fixed_resume_is_immediate(self):
+        self.state.idle_strategy = FixedIdle(1.0)
+        assert self.pause_for(0.1) < 0.05
+        assert self.state.mock.idle.call_count == 1
+
+    def test_blocking_idle_called_once(self):
+        self.state.idle_strategy = BlockingIdle()
+        self.pause_for(0.1)
+        assert self.state.mock.idle.call_count == 1
+
+    def test_backoff_idle(self):
+        self.state.idle_strategy = BackoffIdle(0.001, 0.1)
+        self.pause_for(0.1)
+        assert 2 <= self.state.mock.idle.call_count < 10
+
+
+class StampState(AbstractState):
+    def __init__(self, name, outcomes=[], execute_iterations=20, execute_time=0.0):
+        AbstractState.__init__(self, name, outcomes)
+        self.stamps = []
+        self.execute_iterations = execute_iterations
+        self.execute_time = execute_time
+
+    def begin(self, data=None):
+        pass
+
+    def execute(self, data=None):
+        self.stamps.append(time.perf_counter())
+        if self.execute_time:
+            time.sleep(self.execute_time)
+        return self.outcomes[0] if len(self.stamps) >= self.execute_iterations else None
+
+    def end(self, data=None):
+        pass
+
+
+class TestRate(unittest.TestCase):
+    def check_cadence(self, policy):
+        class DeadlineState(StampState):
+            def execute(self, data=None):
+                self.deadlines.append(self.rate.deadline)
+                return StampState.execute(self, data)
+
+        state = DeadlineState("test1", ["exit"], execute_iterations=21)
+        state.deadlines = []
+        state.set_rate(200, policy)
+        state._run()
+        rate = state.rate
+        # drift free: every deadline is the previous one plus the period, except where an overrun re-anchored it
+        steps = [b - a for a, b in zip(state.deadlines, state.deadlines[1:])]
+        assert sum(1 for step in steps if abs(step - rate.period) > 1e-9) <= rate.overruns
+        # a loaded machine may miss a few periods, not most of them
+        assert rate.overruns <= 3
+        elapsed = state.stamps[-1] - state.stamps[0]
+        assert 0.095 < elapsed < 0.15, elapsed
+
+    def test_sleep(self):
+        self.check_cadence("sleep")
+
+    def test_spin(self):
+        self.check_cadence("spin")
+
+    def test_hybrid(self):
+        self.check_cadence("hybrid")
+
+    def test_overrun(self):
+        overruns = []
+        state = StampState("test1", ["exit"], execute_iterations=5, execute_time=0.02)
+        state.rate = Rate(100, on_overrun=lambda state, lateness: overruns.append(lateness))
+        state._run()
+        assert state.rate.overruns == 4
+        assert len(overruns) == 4 and all(lateness > 0 for lateness in overruns)
+
+    def test_preempt_wakes_rate(self):
+        state = StampState("test1", ["exit"], execute_iterations=1000)
+        state.set_rate(1)
+        execution = Thread(target=state._run)
+        execution.start()
+        time.sleep(0.05)
+        start_time = time.time()
+        state._preempt()
+        execution.join()
+        assert time.time() - start_time < 0.1
+        assert len(state.stamps) == 1
+
+    def test_machine_rate(self):
+        sm = StateMachine("test_state_machine", ["exit"])
+        state1 = StampState("test1", ["s2"], execute_iterations=3)
+        state2 = StampState("test2", ["exit"], execute_iterations=3)
+        sm.add_state(state1, {"s2": "test2"}, initial=True)
+        sm.add_state(state2, {})
+        sm.set_rate(50)
+        assert state1.rate is not state2.rate
+        sm._run()
+        assert state2.stamps[-1] - state2.stamps[0] >= 0.039
+
+
 class TestVerticalStackStateMachines(unittest.TestCase):  # TODO : add asserts
     def setUp(self):
         self.base_sm = StateMachine("test_state_machine", ["exit", "__preempted__"])
@@ -388,6 +702,63 @@ class TestTransitionErrorStateMachine(unittest.TestCase):
         assert error is not None
 
 
+class TestCompiledStateMachine(unittest.TestCase):
+    def setUp(self):
+        self.sm = StateMachine("test_state_machine", ["exit"])
+        self.state1 = TestStateLoop("test1", ["s2", "s3"])
+        self.state2 = TestStateLoop("test2", ["s1", "s1"])
+        self.state3 = TestStateLoop("test3", ["s1", "exit"])
+
+    def test_compile(self):
+        self.sm.add_state(self.state1, {"s2": "test2", "s3": "test3"}, initial=True)
+        self.sm.add_state(self.state2, {"s1": "test1"})
+        self.sm.add_state(self.state3, {"s1": "test1"})
+        assert self.sm.compile() is self.sm
+        assert self.sm._run() == "exit"
+
+    def test_default_initial_state(self):
+        self.sm.add_state(self.state3, {"s1": "test1"})
+        self.sm.add_state(self.state1, {"s2": "test2", "s3": "test3"})
+        self.sm.add_state(self.state2, {"s1": "test1"})
+        self.sm.compile()
+        assert self.sm.initial_state is self.state3
+
+    def test_dangling_target(self):
+        self.sm.add_state(self.state1, {"s2": "test2", "s3": "missing"}, initial=True)
+        self.sm.add_state(self.state2, {"s1": "test1"})
+        with self.assertRaises(TransitionError):
+            self.sm.compile()
+
+    def test_unhandled_outcome(self):
+        self.sm.add_state(self.state1, {"s2": "test2"}, initial=True)
+        self.sm.add_state(self.state2, {"s1": "test1"})
+        with self.assertRaises(TransitionError):
+            self.sm.compile()
+
+    def test_unreachable_state(self):
+        self.sm.add_state(self.state1, {"s2": "test2", "s3": "test2"}, initial=True)
+        self.sm.add_state(self.state2, {"s1": "test1"})
+        self.sm.add_state(self.state3, {"s1": "test1"})
+        with self.assertRaises(TransitionError):
+            self.sm.compile()
+
+    def test_nested_validation(self):
+        inner = StateMachine("inner", ["exit"])
+        inner.add_state(self.state1, {"s2": "test2"}, initial=True)
+        inner.add_state(self.state2, {"s1": "test1"})
+        self.sm.add_state(inner, {}, initial=True)
+        with self.assertRaises(TransitionError):
+            self.sm.compile()
+
+    def test_add_state_invalidates(self):
+        self.sm.add_state(self.state1, {"s2": "test2", "s3": "test3"}, initial=True)
+        self.sm.add_state(self.state2, {"s1": "test1"})
+        with self.assertRaises(TransitionError):
+            self.sm.compile()
+        self.sm.add_state(self.state3, {"s1": "test1"})
+        self.sm.compile()
+
+
 class TestMonitoredState(MonitoredState):
     def __init__(self, name, event_cb, outcomes=[], execute_iterations=3):
         MonitoredState.__init__(self, name, event_cb, outcomes)
@@ -530,5 +901,1744 @@ class TestMonitoredStateMachine(unittest.TestCase):
         assert self.mock.call_count == 3
 
 
+class TestEventDispatch(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+
+    def test_inline_ordered_events(self):
+        state = TestMonitoredState("test1", self.events.append, ["exit"], execute_iterations=2)
+        state.dispatcher = InlineDispatcher()
+        state._run()
+        assert self.events == ["on_begin", "on_execute", "on_execute", "on_end"]
+        assert all(event.state == "test1" for event in self.events)
+        assert self.events[0].timestamp <= self.events[-1].timestamp
+
+    def test_queue_ordered_events(self):
+        dispatcher = QueueDispatcher()
+        state = TestMonitoredState("test1", self.events.append, ["exit"], execute_iterations=5)
+        state.dispatcher = dispatcher
+        state._run()
+        assert dispatcher.flush(1.0)
+        assert self.events == ["on_begin"] + ["on_execute"] * 5 + ["on_end"]
+        dispatcher.close()
+
+    def test_drop_policy(self):
+        dispatcher = QueueDispatcher(maxsize=2, policy="drop")
+        blocker = Mock(side_effect=lambda event: time.sleep(0.05))
+        state = MonitoredState("test1", blocker, ["exit"], dispatcher=dispatcher)
+        for i in range(10):
+            state._notify("on_execute")
+        dispatcher.flush()
+        assert dispatcher.dropped > 0
+        assert blocker.call_count + dispatcher.dropped == 10
+        dispatcher.close()
+
+    def test_coalesce_policy(self):
+        dispatcher = QueueDispatcher(policy="coalesce")
+        blocker = Mock(side_effect=lambda event: time.sleep(0.05))
+        state = MonitoredState("test1", blocker, ["exit"], dispatcher=dispatcher)
+        state._notify("on_begin")
+        time.sleep(0.01)
+        for i in range(10):
+            state._notify("on_execute")
+        state._notify("on_end")
+        dispatcher.flush()
+        assert [c.args[0] for c in blocker.call_args_list] == ["on_begin", "on_execute", "on_end"]
+        assert dispatcher.dropped == 9
+        dispatcher.close()
+
+    def test_thread_pool(self):
+        dispatcher = ThreadPoolDispatcher(workers=4)
+        state = TestMonitoredState("test1", self.events.append, ["exit"], execute_iterations=5)
+        state.dispatcher = dispatcher
+        state._run()
+        dispatcher.flush()
+        assert sorted(self.events) == sorted(["on_begin"] + ["on_execute"] * 5 + ["on_end"])
+        dispatcher.close()
+
+
+class TestAsyncState(AsyncState):
+    def __init__(self, name, outcomes=[], execute_iterations=3):
+        AsyncState.__init__(self, name, outcomes)
+        self.mock = Mock()
+        self.test_execute = 0
+        self.execute_iterations = execute_iterations
+
+    async def begin(self, data=None):
+        self.mock.begin()
+
+    async def execute(self, data=None):
+        self.mock.execute()
+        self.test_execute += 1
+        await asyncio.sleep(0.01)
+        return self.outcomes[0] if self.test_execute >= self.execute_iterations else None
+
+    async def end(self, data=None):
+        self.mock.end()
+
+
+class TestAsyncStateMachine(unittest.TestCase):
+    def setUp(self):
+        self.iterations_num = 3
+        self.sm = AsyncStateMachine("test_state_machine", ["exit"])
+        self.state1 = TestAsyncState("test1", ["s2"], execute_iterations=self.iterations_num)
+        self.state2 = TestState("test2", ["s3"], execute_iterations=self.iterations_num)
+        self.state3 = TestAsyncState("test3", ["exit"], execute_iterations=self.iterations_num)
+        self.sm.add_state(self.state1, {"s2": "test2"}, initial=True)
+        self.sm.add_state(self.state2, {"s3": "test3"})
+        self.sm.add_state(self.state3, {})
+
+    def test_basic(self):
+        assert asyncio.run(self.sm._run_async()) == "exit"
+        for state in (self.state1, self.state2, self.state3):
+            assert state.mock.begin.call_count == 1
+            assert state.mock.execute.call_count == self.iterations_num
+            assert state.mock.end.call_count == 1
+
+    def test_sync_run(self):
+        assert self.sm._run() == "exit"
+
+    def test_pause(self):
+        async def scenario():
+            execution = asyncio.ensure_future(self.sm._run_async())
+            await asyncio.sleep(0.015)
+            self.sm._pause_in()
+            executed = self.state1.test_execute
+            await asyncio.sleep(0.05)
+            assert self.state1.test_execute <= executed + 1
+            self.sm._pause_out()
+            return await execution
+
+        assert asyncio.run(scenario()) == "exit"
+        assert self.state3.mock.end.call_count == 1
+
+    def test_preempt(self):
+        async def scenario():
+            execution = asyncio.ensure_future(self.sm._run_async())
+            await asyncio.sleep(0.015)
+            self.sm._preempt()
+            return await execution
+
+        assert asyncio.run(scenario()) == "__preempted__"
+        self.state1.mock.end.assert_not_called()
+        self.state2.mock.begin.assert_not_called()
+
+    def test_preempt_sync_child(self):
+        async def scenario():
+            execution = asyncio.ensure_future(self.sm._run_async())
+            await asyncio.sleep(0.05)
+            self.sm._preempt()
+            return await execution
+
+        assert asyncio.run(scenario()) == "__preempted__"
+        self.state2.mock.end.assert_not_called()
+        self.state3.mock.begin.assert_not_called()
+
+    def test_many_machines(self):
+        machines = []
+        for i in range(500):
+            sm = AsyncStateMachine("test_state_machine" + str(i), ["exit"])
+            sm.add_state(TestAsyncState("test1", ["exit"], execute_iterations=2), {}, initial=True)
+            machines.append(sm)
+
+        async def scenario():
+            return await asyncio.gather(*(sm._run_async() for sm in machines))
+
+        assert set(asyncio.run(scenario())) == {"exit"}
+
+
+class CountingState(AbstractState):
+    def __init__(self, name, outcomes=[]):
+        AbstractState.__init__(self, name, outcomes)
+
+    def begin(self, data=None):
+        pass
+
+    def execute(self, data=None):
+        data[0] += 1
+        return self.outcomes[0] if data[0] >= data[1] else None
+
+    def end(self, data=None):
+        pass
+
+
+class VectorCountingState(CountingState):
+    def begin_batch(self, data_batch):
+        pass
+
+    def execute_batch(self, data_batch):
+        data_batch[:, 0] += 1
+        return np.where(data_batch[:, 0] >= data_batch[:, 1], 0, -1)
+
+    def end_batch(self, data_batch):
+        pass
+
+
+class ParityState(CountingState):
+    def execute(self, data=None):
+        return "even" if data[0] % 2 == 0 else "odd"
+
+
+@unittest.skipIf(np is None, "numpy not available")
+class TestBatchStateMachine(unittest.TestCase):
+    def build(self, counting_class):
+        sm = StateMachine("test_state_machine", ["even", "odd"])
+        sm.add_state(counting_class("count", ["done"]), {"done": "parity"}, initial=True)
+        sm.add_state(ParityState("parity", ["even", "odd"]), {})
+        return sm
+
+    def check(self, counting_class):
+        data = np.zeros((1000, 2), dtype=np.int64)
+        data[:, 1] = np.arange(1000) % 7 + 1
+        outcomes = BatchStateMachine(self.build(counting_class)).run(data)
+        assert (data[:, 0] == data[:, 1]).all()
+        expected = np.where(data[:, 1] % 2 == 0, "even", "odd")
+        assert list(outcomes) == list(expected)
+
+    def test_vectorized(self):
+        self.check(VectorCountingState)
+
+    def test_fallback(self):
+        self.check(CountingState)
+
+    def test_max_steps(self):
+        data = np.zeros((10, 2), dtype=np.int64)
+        data[:, 1] = 5
+        outcomes = BatchStateMachine(self.build(VectorCountingState)).run(data, max_steps=3)
+        assert list(outcomes) == [None] * 10
+        assert (data[:, 0] == 3).all()
+
+    def test_unrouted_outcome(self):
+        sm = StateMachine("test_state_machine", ["exit"])
+        sm.add_state(ParityState("parity", ["exit"]), {}, initial=True)
+        with self.assertRaises(TransitionError):
+            BatchStateMachine(sm).run(np.zeros((4, 2), dtype=np.int64))
+
+    def test_guarded_transition(self):
+        sm = self.build(VectorCountingState)
+        sm.transitions["count"]["done"] = [Guard("parity", when("count", ">", 0))]
+        with self.assertRaises(TransitionError):
+            BatchStateMachine(sm)
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.sm = StateMachine("test_state_machine", ["exit"])
+        self.state1 = TestState("test1", ["s2"], execute_iterations=3)
+        self.state2 = TestState("test2", ["exit"], execute_iterations=2)
+        self.sm.add_state(self.state1, {"s2": "test2"}, initial=True)
+        self.sm.add_state(self.state2, {})
+
+    def test_disabled_by_default(self):
+        self.sm._run()
+        assert self.state1._profiler is None
+
+    def test_counts(self):
+        profiler = Profiler().attach(self.sm)
+        self.sm._run()
+        stats = profiler.to_dict()
+        assert stats["states"]["test_state_machine/test1"]["begin"]["count"] == 1
+        assert stats["states"]["test_state_machine/test1"]["execute"]["count"] == 3
+        assert stats["states"]["test_state_machine/test2"]["execute"]["count"] == 2
+        assert stats["states"]["test_state_machine/test2"]["end"]["count"] == 1
+        assert stats["states"]["test_state_machine"]["execute"]["count"] == 1
+        execute = stats["states"]["test_state_machine/test1"]["execute"]
+        assert sum(execute["buckets"].values()) == 3
+        assert execute["sum_ns"] >= 3 * 10000000
+        assert execute["buckets"][100000000] == 3
+        transitions = dict(((t["from"], t["outcome"], t["to"]), t["count"]) for t in stats["transitions"])
+        assert transitions == {("test1", "s2", "test2"): 1, ("test2", "exit", None): 1}
+
+    def test_detach_and_reset(self):
+        profiler = Profiler().attach(self.sm)
+        self.sm._run()
+        profiler.reset()
+        profiler.detach(self.sm)
+        self.sm._run()
+        assert profiler.to_dict()["states"]["test_state_machine/test1"]["execute"]["count"] == 0
+
+    def test_same_names(self):
+        sm = StateMachine("root", ["exit"])
+        for name, outcome, iterations in (("first", "done", 1), ("second", "exit", 2)):
+            nested = StateMachine(name, [outcome])
+            nested.add_state(TestState("work", [outcome], execute_iterations=iterations), {}, initial=True)
+            sm.add_state(nested, {"done": "second"} if outcome == "done" else {}, initial=name == "first")
+        profiler = Profiler().attach(sm)
+        assert sm._run() == "exit"
+        stats = profiler.to_dict()
+        assert stats["states"]["root/first/work"]["execute"]["count"] == 1
+        assert stats["states"]["root/second/work"]["execute"]["count"] == 2
+        machines = set(transition["machine"] for transition in stats["transitions"])
+        assert machines == {"root", "root/first", "root/second"}
+
+    def test_async_hooks(self):
+        state = TestAsyncState("async", ["exit"])
+        profiler = Profiler().attach(state)
+        assert state._run() == "exit"
+        stats = profiler.to_dict()["states"]["async"]
+        assert stats["begin"]["count"] == 1 and stats["end"]["count"] == 1
+        assert stats["execute"]["count"] == 3 and stats["execute"]["sum_ns"] >= 3 * 10000000
+
+    def test_prometheus(self):
+        profiler = Profiler().attach(self.sm)
+        self.sm._run()
+        text = profiler.to_prometheus()
+        labels = 'state="test_state_machine/test1",phase="execute"'
+        assert "state_machine_phase_seconds_count{%s} 3" % labels in text
+        assert 'state_machine_phase_seconds_bucket{%s,le="+Inf"} 3' % labels in text
+        labels = 'machine="test_state_machine",from="test1",outcome="s2",to="test2"'
+        assert "state_machine_transitions_total{%s} 1" % labels in text
+
+
+class TestStateRegistry(unittest.TestCase):
+    def build(self, i):
+        sm = StateMachine("registry_machine" + str(i), ["exit"])
+        sm.add_state(StampState("registry_state", ["exit"]), {}, initial=True)
+        return sm
+
+    def test_lookup(self):
+        sm = self.build(0)
+        assert AbstractState.registry.get(id(sm)) is sm
+        assert sm in AbstractState.registry.find("registry_machine0")
+        assert sm in list(AbstractState.registry)
+
+    def test_released(self):
+        before = len(AbstractState.registry)
+        sm = self.build(0)
+        sm_id = id(sm)
+        assert len(AbstractState.registry) == before + 2
+        del sm
+        assert AbstractState.registry.get(sm_id) is None
+        assert len(AbstractState.registry) == before
+
+    def test_memory_flat(self):
+        tracemalloc.start()
+        for i in range(2000):
+            self.build(i)
+        first, peak = tracemalloc.get_traced_memory()
+        for i in range(20000):
+            self.build(i)
+        second, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert second - first < 64 * 1024
+
+
+class SummingState(StampState):
+    def execute(self, data=None):
+        if data is not None and not self.stamps:
+            data.total = int(data.values.sum()) if np is not None else sum(data.values)
+            data.doubled = data.values * 2
+            data.reversed = bytes(data.raw[::-1])
+        return StampState.execute(self, data)
+
+    def pause_in(self, data=None):
+        pass
+
+    def pause_out(self, data=None):
+        pass
+
+
+class FailingState(StampState):
+    def execute(self, data=None):
+        raise ValueError("failing state")
+
+
+class ExitingState(StampState):
+    def execute(self, data=None):
+        os._exit(3)
+
+
+def build_process_machine():
+    sm = StateMachine("process_machine", ["exit"])
+    sm.add_state(SummingState("test1", ["s2"], execute_iterations=2), {"s2": "test2"}, initial=True)
+    sm.add_state(SummingState("test2", ["exit"], execute_iterations=2), {})
+    return sm
+
+
+class TestProcessState(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = ProcessPool(2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+
+    def test_outcome(self):
+        state = ProcessState("process", SummingState, ["exit"], args=("test1", ["exit"], 3), pool=self.pool)
+        sm = StateMachine("test_state_machine", ["exit"])
+        sm.add_state(state, {}, initial=True)
+        assert sm._run() == "exit"
+
+    def test_sub_state_machine(self):
+        state = ProcessState("process", build_process_machine, ["exit"], pool=self.pool)
+        assert state._run() == "exit"
+
+    @unittest.skipIf(np is None, "numpy not available")
+    def test_passing_data(self):
+        data = PassingData(values=np.arange(10), raw=b"abc", untouched=[1])
+        state = ProcessState("process", SummingState, ["exit"], args=("test1", ["exit"], 1), pool=self.pool)
+        assert state._run(data) == "exit"
+        assert data.total == 45
+        assert list(data.doubled) == list(range(0, 20, 2))
+        assert data.reversed == b"cba"
+        assert data.version("untouched") == 1
+
+    def test_pause_and_preempt(self):
+        state = ProcessState("process", SummingState, ["exit"], args=("test1", ["exit"], 100000), pool=self.pool)
+        execution = Thread(target=state._run)
+        execution.start()
+        time.sleep(0.2)
+        state.pause(True)
+        assert state.is_paused()
+        time.sleep(0.05)
+        state.pause(False)
+        start_time = time.time()
+        assert state._preempt(timeout=1.0)
+        assert time.time() - start_time < 0.5
+        execution.join()
+
+    def test_error(self):
+        state = ProcessState("process", FailingState, ["exit"], args=("test1", ["exit"]), pool=self.pool)
+        with self.assertRaises(ProcessStateError):
+            state._run()
+
+    def test_worker_died(self):
+        pool = ProcessPool(1)
+        try:
+            worker = pool._workers[0]
+            state = ProcessState("process", ExitingState, ["exit"], args=("test1", ["exit"]), pool=pool)
+            with self.assertRaises(ProcessStateError):
+                state._run()
+            # the dead worker was replaced, the next run does not hit a broken pipe
+            assert pool._workers[0] is not worker and not worker.process.is_alive()
+            state = ProcessState("process", SummingState, ["exit"], args=("test1", ["exit"], 1), pool=pool)
+            assert state._run() == "exit"
+        finally:
+            pool.close()
+
+    def test_stopped_before_run(self):
+        pool = Mock()
+        state = ProcessState("process", SummingState, ["exit"], args=("test1", ["exit"], 1), pool=pool)
+        sm = StateMachine("test_state_machine", ["exit"])
+        sm.add_state(state, {}, initial=True)
+        sm.compile()
+        sm._token.cancel(PREEMPTED)
+        assert state._run() == "__preempted__"
+        pool.acquire.assert_not_called()
+
+
+class TestConcurrentState(unittest.TestCase):
+    def setUp(self):
+        self.fast = TestState("fast", ["done"], execute_iterations=2)
+        self.slow = TestState("slow", ["done"], execute_iterations=10)
+        self.failed = TestState("failed", ["failed"], execute_iterations=4)
+
+    def build(self, *args, **kwargs):
+        concurrent = ConcurrentState("concurrent", *args, **kwargs)
+        concurrent.add_state(self.fast)
+        concurrent.add_state(self.slow)
+        return concurrent
+
+    def test_join_all(self):
+        concurrent = self.build(["done"])
+        start_time = time.time()
+        assert concurrent._run() == "done"
+        assert time.time() - start_time < 0.1 * 2
+        assert self.fast.mock.end.call_count == 1
+        assert self.slow.mock.end.call_count == 1
+
+    def test_join_any(self):
+        concurrent = self.build(["done"], join="any")
+        assert concurrent._run() == "done"
+        assert self.fast.mock.end.call_count == 1
+        self.slow.mock.end.assert_not_called()
+        assert self.slow.test_execute < 10
+
+    def test_outcome_map(self):
+        outcome_map = {"aborted": {"failed": "failed"}}
+        concurrent = ConcurrentState("concurrent", ["succeeded", "aborted"], outcome_map=outcome_map)
+        concurrent.add_state(self.failed)
+        concurrent.add_state(self.slow)
+        assert concurrent._run() == "aborted"
+        self.slow.mock.end.assert_not_called()
+
+    def test_default_outcome(self):
+        concurrent = ConcurrentState("concurrent", ["mixed"], default_outcome="mixed")
+        concurrent.add_state(self.failed)
+        concurrent.add_state(self.fast)
+        assert concurrent._run() == "mixed"
+
+    def test_no_match(self):
+        concurrent = ConcurrentState("concurrent", ["done"])
+        concurrent.add_state(self.failed)
+        concurrent.add_state(self.fast)
+        with self.assertRaises(TransitionError):
+            concurrent._run()
+
+    def test_executor(self):
+        with ThreadPoolExecutor(2) as executor:
+            concurrent = self.build(["done"], executor=executor)
+            assert concurrent._run() == "done"
+
+    def test_preempt(self):
+        concurrent = self.build(["done"])
+        execution = Thread(target=concurrent._run)
+        execution.start()
+        time.sleep(0.03)
+        assert concurrent._preempt(timeout=1.0)
+        execution.join()
+        self.slow.mock.end.assert_not_called()
+        assert concurrent.is_preempted()
+
+    def test_pause(self):
+        concurrent = self.build(["done"])
+        execution = Thread(target=concurrent._run)
+        execution.start()
+        time.sleep(0.005)
+        PauseThread(concurrent, 0.03).start()
+        execution.join()
+        assert self.slow.mock.pause_in.call_count == 1
+        assert self.slow.mock.pause_out.call_count == 1
+
+    def test_in_state_machine(self):
+        sm = StateMachine("test_state_machine", ["exit"])
+        sm.add_state(self.build(["done"], join="any"), {"done": "next"}, initial=True)
+        sm.add_state(TestState("next", ["exit"], execute_iterations=1), {})
+        assert sm._run() == "exit"
+
+
+def build_checkpoint_nested():
+    nested = StateMachine("nested", ["done"])
+    nested.add_state(TestState("b1", ["next"]), {"next": "b2"}, initial=True)
+    nested.add_state(TestState("b2", ["done"], execute_iterations=5), {})
+    return nested
+
+
+def build_checkpoint_machine(lazy=False):
+    sm = StateMachine("root", ["exit"])
+    sm.add_state(TestState("a", ["next"]), {"next": "nested"}, initial=True)
+    nested = LazyState("nested", build_checkpoint_nested, ["done"]) if lazy else build_checkpoint_nested()
+    sm.add_state(nested, {"done": "c"})
+    sm.add_state(TestState("c", ["exit"]), {})
+    return sm
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "machine.ckpt")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def crash_in_b2(self, data=None, save=False, lazy=False, pause=None):
+        sm = build_checkpoint_machine(lazy)
+        checkpoint = Checkpoint(sm, self.path).attach()
+        execution = Thread(target=sm._run, args=(data,))
+        execution.start()
+        nested = sm.states["nested"]
+        while lazy and nested.state is None:
+            time.sleep(0.001)
+        b2 = (nested.state if lazy else nested).states["b2"]
+        while b2.mock.execute.call_count == 0:
+            time.sleep(0.001)
+        paused = {"root": sm, "b2": b2, None: None}[pause]
+        if paused is not None:
+            paused.pause(True)
+        if save:
+            checkpoint.save(data)
+        # a crash: nothing after this point reaches the log
+        checkpoint.close()
+        if paused is not None:
+            paused.pause(False)
+        sm._preempt()
+        execution.join()
+
+    def test_resume_from_log(self):
+        self.crash_in_b2()
+        sm = build_checkpoint_machine()
+        assert Checkpoint(sm, self.path).restore()
+        assert sm._run() == "exit"
+        sm.states["a"].mock.begin.assert_not_called()
+        sm.states["nested"].states["b1"].mock.begin.assert_not_called()
+        assert sm.states["nested"].states["b2"].mock.begin.call_count == 1
+        assert sm.states["c"].mock.end.call_count == 1
+
+    def test_snapshot_and_data(self):
+        self.crash_in_b2(PassingData(value=42), save=True)
+        assert os.path.getsize(self.path + ".wal") == 0
+        sm = build_checkpoint_machine()
+        data = PassingData()
+        assert Checkpoint(sm, self.path).restore(data)
+        assert data.value == 42
+        assert sm._run(data) == "exit"
+        sm.states["a"].mock.begin.assert_not_called()
+
+    def test_nothing_to_restore(self):
+        sm = build_checkpoint_machine()
+        assert not Checkpoint(sm, self.path).restore()
+        assert sm._run() == "exit"
+
+    def test_default_initial(self):
+        def build():
+            # no initial=True anywhere, compile() picks the first states
+            sm = StateMachine("root", ["exit"])
+            nested = StateMachine("nested", ["exit"])
+            nested.add_state(TestState("b1", ["exit"]), {})
+            sm.add_state(TestState("a", ["next"]), {"next": "nested"})
+            sm.add_state(nested, {})
+            return sm
+
+        sm = build()
+        checkpoint = Checkpoint(sm, self.path).attach()
+        assert sm._run() == "exit"
+        checkpoint.close()
+        sm = build()
+        assert Checkpoint(sm, self.path).restore()
+        assert sm.current_state.name == "nested"
+        assert sm._run() == "exit"
+        sm.states["a"].mock.begin.assert_not_called()
+
+    def test_off_path_machine_restarts(self):
+        sm = build_checkpoint_machine()
+        checkpoint = Checkpoint(sm, self.path).attach()
+        sm._run()
+        checkpoint.close()
+        sm = build_checkpoint_machine()
+        assert Checkpoint(sm, self.path).restore()
+        assert sm.current_state.name == "c"
+        assert sm.states["nested"]._resume_state is None
+
+    def test_paused(self):
+        sm = build_checkpoint_machine()
+        checkpoint = Checkpoint(sm, self.path)
+        sm._pause_in()
+        checkpoint.save()
+        sm = build_checkpoint_machine()
+        Checkpoint(sm, self.path).restore()
+        execution = Thread(target=sm._run)
+        execution.start()
+        time.sleep(0.05)
+        assert sm.is_paused()
+        sm.states["a"].mock.begin.assert_not_called()
+        sm.pause(False)
+        execution.join()
+        assert sm.states["c"].mock.end.call_count == 1
+
+    def test_paused_child(self):
+        self.crash_in_b2(save=True, pause="b2")
+        sm = build_checkpoint_machine()
+        assert Checkpoint(sm, self.path).restore()
+        b2 = sm.states["nested"].states["b2"]
+        execution = Thread(target=sm._run)
+        execution.start()
+        time.sleep(0.05)
+        assert b2.is_paused() and not sm.is_paused()
+        b2.mock.execute.assert_not_called()
+        b2.pause(False)
+        execution.join()
+        assert b2.mock.pause_out.call_count == 1
+        assert sm.states["c"].mock.end.call_count == 1
+
+    def test_resume_hooks(self):
+        self.crash_in_b2(save=True, pause="root")
+        sm = build_checkpoint_machine()
+        assert Checkpoint(sm, self.path).restore()
+        execution = Thread(target=sm._run)
+        execution.start()
+        time.sleep(0.05)
+        assert sm.is_paused()
+        sm.pause(False)
+        execution.join()
+        b2 = sm.states["nested"].states["b2"]
+        assert b2.mock.pause_out.call_count == 1 and b2.mock.end.call_count == 1
+        # c was not paused when the checkpoint was taken
+        sm.states["c"].mock.pause_out.assert_not_called()
+
+    def test_lazy_machine(self):
+        self.crash_in_b2(lazy=True)
+        sm = build_checkpoint_machine(lazy=True)
+        assert Checkpoint(sm, self.path).restore()
+        assert sm._run() == "exit"
+        nested = sm.states["nested"].state
+        sm.states["a"].mock.begin.assert_not_called()
+        nested.states["b1"].mock.begin.assert_not_called()
+        assert nested.states["b2"].mock.begin.call_count == 1
+
+    def test_torn_record(self):
+        self.crash_in_b2()
+        with open(self.path + ".wal", "ab") as f:
+            f.write(b"\x01")
+        sm = build_checkpoint_machine()
+        Checkpoint(sm, self.path).restore()
+        assert sm.current_state.name == "nested"
+
+    def test_mismatch(self):
+        Checkpoint(build_checkpoint_machine(), self.path).save()
+        sm = StateMachine("root", ["exit"])
+        sm.add_state(TestState("a", ["exit"]), {}, initial=True)
+        with self.assertRaises(CheckpointError):
+            Checkpoint(sm, self.path).restore()
+
+
+class TestTransitionLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.log = TransitionLog(8)
+        self.sm = build_checkpoint_machine()
+        self.sm.transition_log = self.log
+        self.sm.states["nested"].transition_log = self.log
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_records(self):
+        self.sm._run()
+        records = [(r.machine, r.state, r.outcome, r.target) for r in self.log.records()]
+        assert records == [
+            ("root", "a", "next", "nested"),
+            ("nested", "b1", "next", "b2"),
+            ("nested", "b2", "done", None),
+            ("root", "nested", "done", "c"),
+            ("root", "c", "exit", None),
+        ]
+        assert all(r.duration_ns > 0 for r in self.log.records())
+
+    def test_ring_buffer(self):
+        for i in range(3):
+            self.sm._run()
+        assert len(self.log) == 8
+        assert self.log.records()[-1].state == "c"
+
+    def test_dump_and_load(self):
+        self.sm._run()
+        for dump in ("dump_jsonl", "dump_binary"):
+            path = os.path.join(self.directory.name, dump)
+            getattr(self.log, dump)(path)
+            assert TransitionLog.load(path) == self.log.records()
+
+    def test_wide_binary(self):
+        # more names than a 16 bit index and a name longer than a 16 bit length
+        log = TransitionLog(70000)
+        for i in range(70000):
+            log.append("m", "s%d" % i, "o", None, i)
+        log.append("m", "x" * 70000, "o", None, 0)
+        path = os.path.join(self.directory.name, "wide")
+        log.dump_binary(path)
+        assert TransitionLog.load(path) == log.records()
+
+    def test_load_old_binary(self):
+        content = struct.pack("<4sII", b"SMTL", 2, 1) + b"".join(struct.pack("<H", 1) + name for name in (b"m", b"s"))
+        content += struct.pack("<QHHHHQ", 5, 0, 1, 1, 0xFFFF, 7)
+        path = os.path.join(self.directory.name, "old")
+        with open(path, "wb") as f:
+            f.write(content)
+        assert TransitionLog.load(path) == [TransitionRecord(5, "m", "s", "s", None, 7)]
+
+    def test_concurrent_appends(self):
+        log = TransitionLog(40000)
+
+        def append():
+            for i in range(10000):
+                log.append("m", "s", "o", None, i)
+
+        threads = [Thread(target=append) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(log) == 40000 and len(log.records()) == 40000
+
+    def test_replay(self):
+        self.sm._run()
+        self.sm._run()
+        assert replay(build_checkpoint_machine(), self.log.records()) == []
+        changed = StateMachine("root", ["exit"])
+        changed.add_state(TestState("a", ["next"]), {"next": "c"}, initial=True)
+        changed.add_state(TestState("c", ["exit"]), {})
+        mismatches = replay(changed, self.log.records())
+        assert any(record.target == "nested" and target == "c" for record, state, target in mismatches)
+
+    def test_replay_tool(self):
+        self.sm._run()
+        path = os.path.join(self.directory.name, "log")
+        self.log.dump_binary(path)
+        assert state_machine_replay.main([path, "state_machine_test:build_checkpoint_machine"]) == 0
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_results(self):
+        results = state_machine_bench.bench_transitions([10], 10)
+        results += state_machine_bench.bench_nesting([3], 1)
+        results += state_machine_bench.bench_latencies(1)
+        results += state_machine_bench.bench_memory([10])
+        results += state_machine_bench.bench_step(10, 10)
+        assert [r["name"] for r in results] == ["transition"] + ["nested_run"] * 2 + ["preempt_latency"] * 2 + [
+            "resume_latency"
+        ] * 2 + ["memory_per_state"] * 2 + ["step"]
+        assert all(r["value"] > 0 for r in results)
+
+    def test_nested_depth(self):
+        sm = state_machine_bench.build_nested(3)
+        assert sm._run() == "exit"
+        assert sm.initial_state.initial_state.name == "level0"
+
+
+class TestCancelToken(unittest.TestCase):
+    def run_machine(self, sm):
+        self.outcome = None
+        execution = Thread(target=lambda: setattr(self, "outcome", sm._run()))
+        execution.start()
+        return execution
+
+    def test_shared(self):
+        leaf = StampState("leaf", ["exit"])
+        sm = state_machine_bench.build_nested(5, leaf)
+        assert leaf._token is sm._token
+        assert sm._owns_token() and not leaf._owns_token()
+
+    def test_own_conditions(self):
+        # a phase change only wakes the state's own waiters, the token wakes the running states sharing it
+        leaf = StampState("leaf", ["exit"], execute_iterations=10**9, execute_time=0.001)
+        nested = state_machine_bench.build_nested(3, leaf)
+        token = nested._token
+        sm = StateMachine("root", ["exit"])
+        sm.add_state(nested, {"exit": "idle0"}, initial=True)
+        for i in range(100):
+            sm.add_state(StampState("idle%d" % i, ["next"]), {"next": "idle%d" % (i + 1)})
+        sm.add_state(StampState("idle100", ["exit"]), {})
+        sm.compile()
+        assert leaf._phase_changed is not sm._phase_changed
+        assert not token._members and not sm._token._members
+        execution = self.run_machine(sm)
+        while not leaf.stamps:
+            time.sleep(0.001)
+        # only the active path is woken by a stop, not the idle states
+        assert leaf._phase_changed in sm._token._members
+        assert len(sm._token._members) == 5
+        assert sm.preempt(timeout=0.5)
+        execution.join()
+        assert not sm._token._members
+
+    def test_deep_preempt(self):
+        leaf = StampState("leaf", ["exit"], execute_iterations=10**9, execute_time=0.001)
+        sm = state_machine_bench.build_nested(200, leaf)
+        execution = self.run_machine(sm)
+        while not leaf.stamps:
+            time.sleep(0.001)
+        assert sm.preempt(timeout=0.5)
+        execution.join()
+        assert self.outcome == "__preempted__"
+        assert leaf.status().phase == Phase.IDLE
+
+    def test_abort(self):
+        leaf = StampState("leaf", ["exit"], execute_iterations=10**9, execute_time=0.001)
+        sm = state_machine_bench.build_nested(10, leaf)
+        execution = self.run_machine(sm)
+        while not leaf.stamps:
+            time.sleep(0.001)
+        sm._abort()
+        execution.join()
+        assert self.outcome == "__aborted__"
+
+    def test_entering_state_sees_stop(self):
+        sm = StateMachine("root", ["exit"])
+        nested = StateMachine("nested", ["exit"])
+        first = TestState("first", ["next"])
+        second = TestState("second", ["exit"])
+        first.end = Mock(side_effect=lambda data: sm._preempt(None, 0))
+        nested.add_state(first, {"next": "second"}, initial=True)
+        nested.add_state(second, {})
+        sm.add_state(nested, {}, initial=True)
+        assert sm._run() == "__preempted__"
+        second.mock.begin.assert_not_called()
+
+    def test_preempt_timeout(self):
+        leaf = StampState("leaf", ["exit"], execute_iterations=10**9, execute_time=0.3)
+        sm = state_machine_bench.build_nested(3, leaf)
+        execution = self.run_machine(sm)
+        while not leaf.stamps:
+            time.sleep(0.001)
+        with self.assertRaises(PreemptTimeout) as raised:
+            sm.preempt(timeout=0.05)
+        assert raised.exception.state is leaf
+        execution.join()
+        assert self.outcome == "__preempted__"
+
+    def test_local_preempt(self):
+        # preempting a child restarts it from the machine's initial state, the machine keeps running
+        sm = StateMachine("root", ["exit"])
+        leaf = StampState("leaf", ["exit"], execute_iterations=10**9, execute_time=0.001)
+        sm.add_state(leaf, {}, initial=True)
+        execution = self.run_machine(sm)
+        while not leaf.stamps:
+            time.sleep(0.001)
+        leaf._preempt(None, 0)
+        time.sleep(0.02)
+        assert sm.is_executing() and not sm.is_preempted()
+        assert sm.preempt(timeout=1.0)
+        execution.join()
+
+
+class RecordingState(AbstractState):
+    def __init__(self, name, outcomes, calls):
+        AbstractState.__init__(self, name, outcomes)
+        self.calls = calls
+
+    def begin(self, data=None):
+        self.calls.append(("begin", self.name))
+
+    def execute(self, data=None):
+        self.calls.append(("execute", self.name))
+        return self.outcomes[0]
+
+    def end(self, data=None):
+        self.calls.append(("end", self.name))
+
+
+class RecordingMachine(StateMachine):
+    def __init__(self, name, outcomes, calls):
+        StateMachine.__init__(self, name, outcomes)
+        self.calls = calls
+
+    def begin(self, data=None):
+        StateMachine.begin(self, data)
+        self.calls.append(("begin", self.name))
+
+    def end(self, data=None):
+        self.calls.append(("end", self.name))
+
+
+def build_behaviour_tree(calls):
+    inner = RecordingMachine("inner", ["finished"], calls)
+    inner.add_state(RecordingState("c", ["finished"], calls), {}, initial=True)
+    middle = RecordingMachine("middle", ["done"], calls)
+    middle.add_state(RecordingState("b", ["next"], calls), {"next": "inner"}, initial=True)
+    middle.add_state(inner, {"finished": "d"})
+    middle.add_state(RecordingState("d", ["done"], calls), {})
+    root = RecordingMachine("root", ["exit"], calls)
+    root.add_state(RecordingState("a", ["next"], calls), {"next": "middle"}, initial=True)
+    root.add_state(middle, {"done": "e"})
+    root.add_state(RecordingState("e", ["exit"], calls), {})
+    return root
+
+
+class TestFlattening(unittest.TestCase):
+    def run_tree(self, flat):
+        calls = []
+        log = TransitionLog()
+        root = build_behaviour_tree(calls)
+        for machine in (root, root.states["middle"], root.states["middle"].states["inner"]):
+            machine.transition_log = log
+        if flat:
+            root.flatten()
+        assert root._run() == "exit"
+        return calls, [record[1:5] for record in log.records()]
+
+    def test_same_hooks_and_transitions(self):
+        calls, records = self.run_tree(False)
+        flat_calls, flat_records = self.run_tree(True)
+        assert flat_calls == calls
+        assert flat_records == records
+        assert calls.index(("begin", "inner")) < calls.index(("begin", "c"))
+        assert calls.index(("end", "c")) < calls.index(("end", "inner")) < calls.index(("begin", "d"))
+
+    def test_nested_machines_idle(self):
+        phases = []
+        root = build_behaviour_tree([]).flatten()
+        middle = root.states["middle"]
+        middle.states["d"].execute = lambda data: phases.append((root.status().phase, middle.status().phase)) or "done"
+        root._run()
+        assert phases == [(Phase.EXECUTING, Phase.IDLE)]
+        assert middle.current_state.name == "d"
+
+    def test_preempt(self):
+        leaf = StampState("leaf", ["exit"], execute_iterations=10**9, execute_time=0.001)
+        sm = state_machine_bench.build_nested(8, leaf).flatten()
+        execution = Thread(target=sm._run)
+        execution.start()
+        while not leaf.stamps:
+            time.sleep(0.001)
+        assert sm.preempt(timeout=0.5)
+        execution.join()
+        assert sm.initial_state.current_state.initial_state.status().phase == Phase.IDLE
+
+    def test_nested_abort(self):
+        sm = StateMachine("root", ["exit"])
+        nested = StateMachine("nested", ["exit"])
+        nested.add_state(AbortingState("aborting", Mock(), ["exit"]), {}, initial=True)
+        sm.add_state(nested, {}, initial=True)
+        assert sm.flatten()._run() == "__aborted__"
+
+
+class KickingState(StampState):
+    def __init__(self, name, outcomes=[], execute_iterations=20, execute_time=0.0, kicks=None):
+        StampState.__init__(self, name, outcomes, execute_iterations, execute_time)
+        self.kicks = kicks
+
+    def execute(self, data=None):
+        if self.kicks is None or len(self.stamps) < self.kicks:
+            self.kick()
+        return StampState.execute(self, data)
+
+
+class EagerScheduler(TimerScheduler):
+    # fires an entry from another thread before schedule() returns, unless that thread blocks for 50 ms
+    def schedule(self, when, callback):
+        entry = [when, 0, callback]
+        thread = threading.Thread(target=callback, args=(entry,))
+        thread.start()
+        thread.join(0.05)
+        return entry
+
+    def cancel(self, entry):
+        entry[2] = None
+
+
+def build_timeout_machine(state):
+    sm = StateMachine("root", ["exit", "timeout"])
+    sm.add_state(state, {"__timeout__": "recover"}, initial=True)
+    sm.add_state(StampState("recover", ["timeout"], execute_iterations=1), {})
+    return sm
+
+
+class TestTimeouts(unittest.TestCase):
+    def test_timeout_outcome(self):
+        state = StampState("slow", ["exit"], execute_iterations=10**9, execute_time=0.001)
+        state.set_timeout(0.05)
+        sm = build_timeout_machine(state)
+        start_time = time.time()
+        assert sm._run() == "timeout"
+        assert time.time() - start_time < 0.5
+        assert state.is_timed_out()
+
+    def test_fires_while_arming(self):
+        state = StampState("slow", ["exit"], execute_iterations=200, execute_time=0.001)
+        state.set_timeout(0.0)
+        with patch("state_machine.default_scheduler", return_value=EagerScheduler()):
+            assert state._run() == "__timeout__"
+
+    def test_finished_in_time(self):
+        state = StampState("fast", ["exit"], execute_iterations=3)
+        state.set_timeout(0.05)
+        sm = build_timeout_machine(state)
+        assert sm._run() == "exit"
+        time.sleep(0.1)
+        assert state._timer is None and not state.is_timed_out()
+        assert sm._run() == "exit"
+
+    def test_timeout_wakes_idle(self):
+        state = StampState("paused", ["exit"])
+        state.set_timeout(0.05)
+        state.idle_strategy = BlockingIdle()
+        # starts paused, as if restored from a checkpoint
+        state._restore_flags = PAUSED
+        assert state._run() == "__timeout__"
+        assert state.stamps == []
+
+    def test_requires_route(self):
+        sm = StateMachine("root", ["exit"])
+        state = StampState("slow", ["exit"])
+        state.set_timeout(1.0)
+        sm.add_state(state, {}, initial=True)
+        with self.assertRaises(TransitionError):
+            sm.compile()
+
+    def test_watchdog(self):
+        kicked = KickingState("kicked", ["exit"], execute_iterations=30, execute_time=0.005)
+        kicked.set_timeout(None, watchdog=0.05)
+        assert build_timeout_machine(kicked)._run() == "exit"
+        hung = KickingState("hung", ["exit"], execute_iterations=10**9, execute_time=0.005, kicks=5)
+        hung.set_timeout(None, watchdog=0.05)
+        assert build_timeout_machine(hung)._run() == "timeout"
+        assert len(hung.stamps) < 30
+
+    def test_nested_machine(self):
+        for flat in (False, True):
+            leaf = StampState("leaf", ["exit"], execute_iterations=10**9, execute_time=0.001)
+            nested = StateMachine("nested", ["exit"])
+            nested.add_state(leaf, {}, initial=True)
+            nested.set_timeout(0.05)
+            sm = build_timeout_machine(nested)
+            if flat:
+                sm.flatten()
+            assert sm._run() == "timeout"
+            assert leaf.status().phase == Phase.IDLE
+
+    def test_async_machine(self):
+        leaf = StampState("leaf", ["exit"], execute_iterations=10**9, execute_time=0.001)
+        nested = AsyncStateMachine("nested", ["exit"])
+        nested.add_state(leaf, {}, initial=True)
+        nested.set_timeout(0.05)
+        assert build_timeout_machine(nested)._run() == "timeout"
+
+    def test_shared_scheduler(self):
+        threads = threading.active_count()
+        states = [StampState("slow%d" % i, ["exit"], execute_iterations=10**9, execute_time=0.01) for i in range(50)]
+        executions = []
+        for state in states:
+            state.set_timeout(0.05)
+            executions.append(Thread(target=state._run))
+            executions[-1].start()
+        for execution in executions:
+            execution.join()
+        assert all(state.is_timed_out() for state in states)
+        assert threading.active_count() <= threads + 1
+
+    def test_scheduler(self):
+        scheduler = TimerScheduler()
+        fired = []
+        now = time.monotonic()
+        when = [now + 0.1 + 0.01 * (i % 5) for i in range(100)]
+        entries = [scheduler.schedule(when[i], lambda entry, i=i: fired.append(i)) for i in range(100)]
+        for entry in entries[::2]:
+            scheduler.cancel(entry)
+        assert len(scheduler) == 50
+        time.sleep(0.3)
+        assert sorted(fired) == list(range(1, 100, 2))
+        assert len(scheduler) == 0
+
+
+def build_lazy_machine(factory, size):
+    sm = StateMachine("mission", ["exit"])
+    sm.add_state(
+        LazyState("start", factory, ["short", "long"], args=("start", ["short", "long"])),
+        {"short": "end", "long": "s0"},
+        initial=True,
+    )
+    for i in range(size):
+        target = "s%d" % (i + 1) if i + 1 < size else "end"
+        sm.add_state(LazyState("s%d" % i, factory, ["next"], args=("s%d" % i, ["next"])), {"next": target})
+    sm.add_state(LazyState("end", factory, ["exit"], args=("end", ["exit"])), {})
+    return sm
+
+
+class TestLazyState(unittest.TestCase):
+    def setUp(self):
+        self.factory = Mock(side_effect=lambda name, outcomes: StampState(name, outcomes, execute_iterations=1))
+
+    def test_built_on_entry(self):
+        sm = build_lazy_machine(self.factory, 1000)
+        sm.compile()
+        self.factory.assert_not_called()
+        assert sm._run() == "exit"
+        assert [c.args[0] for c in self.factory.call_args_list] == ["start", "end"]
+        assert sm.states["end"].state is sm.current_state
+        assert sm.states["s0"].state is None
+        assert sm.states["end"].state._token is sm._token
+        sm._run()
+        assert self.factory.call_count == 2
+
+    def test_lru_eviction(self):
+        long = Mock(side_effect=lambda name, outcomes: StampState(name, outcomes[-1:], execute_iterations=1))
+        sm = build_lazy_machine(long, 4)
+        sm.lazy_capacity = 2
+        assert sm._run() == "exit"
+        assert [c.args[0] for c in long.call_args_list] == ["start", "s0", "s1", "s2", "s3", "end"]
+        assert [name for name, state in sm.states.items() if state.state is not None] == ["s3", "end"]
+        assert len(sm._routes) == len(sm.states) + 2
+        assert sm._run() == "exit"
+        assert long.call_count == 12
+
+    def test_settings_applied(self):
+        sm = build_lazy_machine(self.factory, 1)
+        sm.states["start"].set_timeout(1.0)
+        with self.assertRaises(TransitionError):
+            sm.compile()
+        sm.transitions["start"]["__timeout__"] = "end"
+        sm.set_rate(1000)
+        profiler = Profiler().attach(sm)
+        assert sm._run() == "exit"
+        start = sm.states["start"].state
+        assert start.timeout == 1.0 and start.rate.period == 0.001
+        assert profiler.to_dict()["states"]["mission/start"]["execute"]["count"] == 1
+
+    def test_wrong_name(self):
+        sm = StateMachine("mission", ["exit"])
+        sm.add_state(LazyState("a", lambda: StampState("b", ["exit"])), {}, initial=True)
+        with self.assertRaises(TransitionError):
+            sm._run()
+
+    def test_checkpoint(self):
+        directory = tempfile.TemporaryDirectory()
+        path = os.path.join(directory.name, "checkpoint")
+        sm = build_lazy_machine(self.factory, 3)
+        checkpoint = Checkpoint(sm, path).attach()
+        sm._run()
+        checkpoint.save()
+        checkpoint.detach()
+        restored = build_lazy_machine(self.factory, 3)
+        assert Checkpoint(restored, path).restore()
+        restored.reset()
+        assert restored.current_state is restored.states["end"].state
+        directory.cleanup()
+
+
+class TestCoreImport(unittest.TestCase):
+    def test_no_heavy_imports(self):
+        code = "import sys, state_machine; print(sorted(set(sys.argv[1:]) & set(sys.modules)))"
+        heavy = ["asyncio", "json", "pickle", "traceback", "vb_utils_ros", "rospy", "numpy"]
+        output = subprocess.run(
+            [sys.executable, "-c", code] + heavy,
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout
+        assert output.strip() == "[]"
+
+    def test_locked_variable(self):
+        variable = LockedVariable(False)
+        assert not variable.retr()
+        variable.store(True)
+        assert variable.retr()
+        assert LockedVariable().retr() is None
+
+
+LOADER_JSON = """{
+ "name": "mission",
+ "outcomes": ["exit"],
+ "initial": "start",
+ "states": {
+  "start": {
+   "class": "StampState",
+   "outcomes": ["next"],
+   "kwargs": {"execute_iterations": 2},
+   "transitions": {"next": "work"}
+  },
+  "work": {
+   "outcomes": ["finished"],
+   "transitions": {"finished": "end"},
+   "states": {
+    "step": {"class": "StampState", "outcomes": ["finished"], "kwargs": {"execute_iterations": 1}, "lazy": true}
+   }
+  },
+  "end": {"class": "StampState", "outcomes": ["exit"], "kwargs": {"execute_iterations": 1}}
+ }
+}"""
+
+LOADER_YAML = """
+name: mission
+outcomes: [exit]
+initial: start
+states:
+  start: {class: StampState, outcomes: [next], kwargs: {execute_iterations: 2}, transitions: {next: work}}
+  work:
+    outcomes: [finished]
+    transitions: {finished: end}
+    states:
+      step: {class: StampState, outcomes: [finished], kwargs: {execute_iterations: 1}, lazy: true}
+  end: {class: StampState, outcomes: [exit], kwargs: {execute_iterations: 1}}
+"""
+
+LOADER_TOML = """
+name = "mission"
+outcomes = ["exit"]
+initial = "start"
+
+[states.start]
+class = "StampState"
+outcomes = ["next"]
+kwargs = {execute_iterations = 2}
+transitions = {next = "work"}
+
+[states.work]
+outcomes = ["finished"]
+transitions = {finished = "end"}
+states.step = {class = "StampState", outcomes = ["finished"], kwargs = {execute_iterations = 1}, lazy = true}
+
+[states.end]
+class = "StampState"
+outcomes = ["exit"]
+kwargs = {execute_iterations = 1}
+"""
+
+
+class TestLoader(unittest.TestCase):
+    def setUp(self):
+        self.registry = ClassRegistry()
+        self.registry.register(StampState)
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    def check_machine(self, sm):
+        assert list(sm.states) == ["start", "work", "end"]
+        assert sm.initial_state is sm.states["start"]
+        assert sm.states["start"].execute_iterations == 2
+        assert isinstance(sm.states["work"], StateMachine)
+        assert isinstance(sm.states["work"].states["step"], LazyState)
+        assert sm._run() == "exit"
+        assert len(sm.states["start"].stamps) == 2
+
+    def test_formats(self):
+        for content, kind in ((LOADER_JSON, "json"), (LOADER_YAML, "yaml"), (LOADER_TOML, "toml")):
+            self.check_machine(state_machine_loader.loads(content, kind, self.registry))
+
+    def test_load_file(self):
+        path = os.path.join(self.cache_dir, "mission.yml")
+        with open(path, "w") as f:
+            f.write(LOADER_YAML)
+        self.check_machine(state_machine_loader.load(path, self.registry))
+        with self.assertRaises(DefinitionError):
+            state_machine_loader.load(os.path.join(self.cache_dir, "mission.ini"), self.registry)
+
+    def test_cache(self):
+        self.check_machine(state_machine_loader.loads(LOADER_YAML, "yaml", self.registry, self.cache_dir))
+        assert len(os.listdir(self.cache_dir)) == 1
+        with patch.object(state_machine_loader, "parse", side_effect=AssertionError("parsed")):
+            sm = state_machine_loader.loads(LOADER_YAML, "yaml", self.registry, self.cache_dir)
+            self.check_machine(sm)
+            # other content is a cache miss
+            with self.assertRaises(AssertionError):
+                state_machine_loader.loads(LOADER_JSON, "json", self.registry, self.cache_dir)
+
+    def test_stale_cache(self):
+        cache = state_machine_loader.DefinitionCache(self.cache_dir)
+        state_machine_loader.loads(LOADER_JSON, "json", self.registry, self.cache_dir)
+        path = cache.path(LOADER_JSON.encode(), "json")
+        with open(path, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b"\0")
+        assert cache.get(LOADER_JSON.encode(), "json") is None
+        self.check_machine(state_machine_loader.loads(LOADER_JSON, "json", self.registry, self.cache_dir))
+        assert cache.get(LOADER_JSON.encode(), "json") is not None
+
+    def test_errors(self):
+        with self.assertRaises(DefinitionError):
+            state_machine_loader.loads(LOADER_JSON, "json", ClassRegistry())
+        with self.assertRaises(DefinitionError):
+            state_machine_loader.loads('{"name": "m", "states": {"a": {"class": "StampState", "next": "b"}}}', "json")
+        with self.assertRaises(DefinitionError):
+            state_machine_loader.loads('{"name": "m", "states": {"a": {"class": "StampState", "lazy": true}}}', "json")
+        definition = '{"name": "m", "states": {"a": {"class": "StampState", "outcomes": ["x"]}}}'
+        with self.assertRaises(TransitionError):
+            state_machine_loader.loads(definition, "json", self.registry, self.cache_dir)
+        assert os.listdir(self.cache_dir) == []
+
+    def test_cache_revalidates(self):
+        # the cached plan is the same, the registered class now has other outcomes
+        class Done(StampState):
+            def __init__(self, name):
+                StampState.__init__(self, name, ["exit"], execute_iterations=1)
+
+        class Renamed(StampState):
+            def __init__(self, name):
+                StampState.__init__(self, name, ["finished"], execute_iterations=1)
+
+        definition = '{"name": "m", "outcomes": ["exit"], "states": {"a": {"class": "Done"}}}'
+        self.registry.register(Done)
+        assert state_machine_loader.loads(definition, "json", self.registry, self.cache_dir)._run() == "exit"
+        self.registry.register(Renamed, "Done")
+        with self.assertRaises(TransitionError):
+            state_machine_loader.loads(definition, "json", self.registry, self.cache_dir)
+
+
+def build_guarded_machine(flat=False):
+    sm = StateMachine("charger", ["exit", "unknown"])
+    sm.add_state(
+        StampState("check", ["measured"], execute_iterations=1),
+        {
+            "measured": [
+                Guard("full", lambda data: data.get("battery") > 80),
+                Guard("low", when("battery", "<", 20), priority=1),
+                Guard("empty", when("battery", "==", 0), priority=2),
+                "normal",
+            ]
+        },
+        initial=True,
+    )
+    for name in ("full", "low", "empty", "normal"):
+        sm.add_state(StampState(name, ["exit"], execute_iterations=1), {})
+    if not flat:
+        return sm.compile()
+    root = StateMachine("root", ["exit"])
+    root.add_state(sm, {"unknown": "guess"}, initial=True)
+    root.add_state(StampState("guess", ["exit"], execute_iterations=1), {})
+    return root.flatten()
+
+
+class TestGuards(unittest.TestCase):
+    def visited(self, sm, battery):
+        sm._run(PassingData(battery=battery))
+        return [name for name, state in sm.states.items() if name != "check" and state.stamps]
+
+    def test_routing(self):
+        for battery, expected in ((0, "empty"), (10, "low"), (50, "normal"), (90, "full")):
+            assert self.visited(build_guarded_machine(), battery) == [expected]
+
+    def test_flat(self):
+        sm = build_guarded_machine(flat=True)
+        sm._run(PassingData(battery=10))
+        assert len(sm.states["charger"].states["low"].stamps) == 1
+
+    def test_no_guard_holds(self):
+        sm = StateMachine("sm", ["unknown"])
+        low = when("battery", "<", 20)
+        sm.add_state(
+            StampState("check", ["measured", "unknown"], execute_iterations=1),
+            {"measured": Guard("low", low), "unknown": [Guard("low", low)]},
+            initial=True,
+        )
+        sm.add_state(StampState("low", ["unknown"], execute_iterations=1), {})
+        assert sm._run(PassingData(battery=10)) == "unknown"
+        assert len(sm.states["low"].stamps) == 1
+        with self.assertRaises(TransitionError):
+            sm._run(PassingData(battery=50))
+        # a missing value never holds
+        assert not when("battery", "<", 20)(PassingData())
+        with self.assertRaises(ValueError):
+            when("battery", "<>", 20)
+
+    def test_compile(self):
+        sm = StateMachine("sm", ["exit"])
+        sm.add_state(StampState("check", ["measured"]), {"measured": [Guard("missing", when("x", "==", 1)), "end"]})
+        sm.add_state(StampState("end", ["exit"]), {})
+        with self.assertRaises(TransitionError):
+            sm.compile()
+        # guarded targets count as reachable
+        sm.transitions["check"]["measured"] = [Guard("other", when("x", "==", 1)), "end"]
+        sm.add_state(StampState("other", ["exit"]), {})
+        sm.compile()
+
+    def test_replay(self):
+        sm = build_guarded_machine()
+        sm.transition_log = TransitionLog(8)
+        sm._run(PassingData(battery=10))
+        assert replay(build_guarded_machine(), sm.transition_log.records()) == []
+
+    def test_loader(self):
+        registry = ClassRegistry()
+        registry.register(StampState)
+        definition = """{
+         "name": "charger",
+         "outcomes": ["exit"],
+         "states": {
+          "check": {
+           "class": "StampState",
+           "outcomes": ["measured"],
+           "kwargs": {"execute_iterations": 1},
+           "transitions": {"measured": [{"target": "low", "when": ["battery", "<", 20]}, "normal"]}
+          },
+          "low": {"class": "StampState", "outcomes": ["exit"], "kwargs": {"execute_iterations": 1}},
+          "normal": {"class": "StampState", "outcomes": ["exit"], "kwargs": {"execute_iterations": 1}}
+         }
+        }"""
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        for i in range(2):
+            sm = state_machine_loader.loads(definition, "json", registry, cache_dir)
+            assert self.visited(sm, 10) == ["low"]
+        with self.assertRaises(DefinitionError):
+            state_machine_loader.loads(definition.replace('"<"', '"<>"'), "json", registry)
+
+
+class SteppingState(StampState):
+    def __init__(self, name, outcomes=[], execute_iterations=1 << 62, fail=False):
+        StampState.__init__(self, name, outcomes, execute_iterations)
+        self.fail = fail
+        self.paused = 0
+        self.resumed = 0
+
+    def execute(self, data=None):
+        if self.fail:
+            raise ValueError("failing state")
+        return StampState.execute(self, data)
+
+    def pause_in(self, data=None):
+        self.paused += 1
+
+    def pause_out(self, data=None):
+        self.resumed += 1
+
+
+def build_stepping_machine(name, iterations, nested=True):
+    sm = StateMachine(name, ["exit"])
+    sm.add_state(SteppingState("a", ["next"], iterations), {"next": "b"}, initial=True)
+    if nested:
+        inner = StateMachine("b", ["finished"])
+        inner.add_state(SteppingState("b1", ["finished"], iterations), {}, initial=True)
+        sm.add_state(inner, {"finished": "c"})
+    else:
+        sm.add_state(SteppingState("b", ["finished"], iterations), {"finished": "c"})
+    sm.add_state(SteppingState("c", ["exit"], iterations), {})
+    return sm
+
+
+class TestRuntime(unittest.TestCase):
+    def setUp(self):
+        self.runtime = Runtime(workers=4)
+
+    def tearDown(self):
+        assert self.runtime.close(5)
+
+    def test_many_machines(self):
+        threads = threading.active_count()
+        machines = [build_stepping_machine("m%d" % i, 5) for i in range(300)]
+        jobs = [self.runtime.submit(sm) for sm in machines]
+        assert threading.active_count() <= threads + 1
+        assert [job.result(10) for job in jobs] == ["exit"] * len(jobs)
+        assert len(self.runtime) == 0
+        # one step per execute, the last execute of each state also takes its transition
+        assert all(job.steps == 15 for job in jobs)
+        assert all(len(sm.states["b"].states["b1"].stamps) == 5 for sm in machines)
+
+    def test_priorities(self):
+        runtime = Runtime(workers=1)
+        low = SteppingState("low", ["exit"])
+        high = SteppingState("high", ["exit"])
+        runtime.submit(low)
+        runtime.submit(high, priority=3)
+        time.sleep(0.2)
+        runtime.pause(True)
+        ratio = len(high.stamps) / len(low.stamps)
+        assert 2.5 < ratio < 3.5, ratio
+        runtime.preempt()
+        assert runtime.close(5)
+        with self.assertRaises(ValueError):
+            runtime.submit(low)
+
+    def test_pause(self):
+        state = SteppingState("spin", ["exit"])
+        job = self.runtime.submit(state)
+        time.sleep(0.05)
+        self.runtime.pause(True)
+        assert state.paused == 1
+        executed = len(state.stamps)
+        time.sleep(0.05)
+        assert len(state.stamps) == executed
+        self.runtime.pause(False)
+        assert state.resumed == 1
+        time.sleep(0.05)
+        assert len(state.stamps) > executed
+        # a stop reaches paused machines too
+        self.runtime.pause(True)
+        self.runtime.preempt(state)
+        assert job.result(5) == "__preempted__"
+        self.runtime.pause(False)
+
+    def test_pause_from_worker(self):
+        stepping = threading.Event()
+        paused = threading.Event()
+
+        class SlowState(SteppingState):
+            def execute(self, data=None):
+                stepping.set()
+                time.sleep(0.05)
+                return SteppingState.execute(self, data)
+
+        runtime = self.runtime
+
+        class PausingState(SteppingState):
+            def execute(self, data=None):
+                stepping.wait(5)
+                # the slow worker is still inside its step
+                runtime.pause(True)
+                paused.set()
+                return self.outcomes[0]
+
+        slow = SlowState("slow", ["exit"])
+        job = runtime.submit(slow)
+        assert stepping.wait(5)
+        assert runtime.submit(PausingState("pausing", ["exit"])).result(5) == "exit"
+        assert paused.is_set()
+        assert runtime.is_paused()
+        runtime.pause(False)
+        runtime.preempt(slow)
+        assert job.result(5) == "__preempted__"
+
+    def test_rate(self):
+        state = SteppingState("slow", ["exit"], 5)
+        state.set_rate(100)
+        runtime = Runtime(workers=1)
+        slow = runtime.submit(state)
+        fast = runtime.submit(build_stepping_machine("fast", 100))
+        # the rate-limited state waits on the timer heap instead of holding the only worker
+        assert fast.result(5) == "exit"
+        assert not slow.done()
+        assert slow.result(5) == "exit"
+        assert state.stamps[-1] - state.stamps[0] >= 0.035
+        assert runtime.close(5)
+
+    def test_failure(self):
+        sm = build_stepping_machine("failing", 2, nested=False)
+        sm.states["b"].fail = True
+        job = self.runtime.submit(sm)
+        with self.assertRaises(ValueError):
+            job.result(5)
+        # the failed run left no state half entered, the next run starts over
+        sm.states["b"].fail = False
+        assert self.runtime.submit(sm).result(5) == "exit"
+        assert len(sm.states["b"].stamps) == 2
+        assert sm.states["b"]._phase == Phase.IDLE
+
+    def test_duplicate(self):
+        state = SteppingState("spin", ["exit"])
+        self.runtime.submit(state)
+        with self.assertRaises(ValueError):
+            self.runtime.submit(state)
+        with self.assertRaises(ValueError):
+            self.runtime.submit(SteppingState("other", ["exit"]), priority=0)
+
+    def test_same_as_run(self):
+        def build(events):
+            sm = StateMachine("root", ["exit"])
+            inner = StateMachine("inner", ["finished"])
+            dispatcher = InlineDispatcher()
+
+            def monitored(name, outcome, iterations):
+                return state_machine_bench.NoopMonitoredState(name, events.append, [outcome], dispatcher, iterations)
+
+            inner.add_state(monitored("b1", "finished", 2), {}, initial=True)
+            sm.add_state(monitored("a", "next", 3), {"next": "inner"}, initial=True)
+            sm.add_state(inner, {"finished": "a2"})
+            sm.add_state(monitored("a2", "exit", 1), {})
+            sm.transition_log = inner.transition_log = TransitionLog(16)
+            return sm
+
+        def trace(sm, events):
+            records = [(r.machine, r.state, r.outcome, r.target) for r in sm.transition_log.records()]
+            return records, [(event.state, str(event)) for event in events]
+
+        run_events, step_events = [], []
+        sm = build(run_events)
+        assert sm._run() == "exit"
+        stepped = build(step_events)
+        assert self.runtime.submit(stepped).result(5) == "exit"
+        assert trace(stepped, step_events) == trace(sm, run_events)
+
+    def test_timeout(self):
+        sm = StateMachine("sm", ["exit", "__timeout__"])
+        state = SteppingState("spin", ["exit"])
+        state.set_timeout(0.05)
+        sm.add_state(state, {}, initial=True)
+        assert self.runtime.submit(sm).result(5) == "__timeout__"
+
+
+class TestStepping(unittest.TestCase):
+    def test_step(self):
+        state = SteppingState("spin", ["exit"], 3)
+        assert [state.step(), state.step(), state.step()] == [None, None, "exit"]
+        assert len(state.stamps) == 3
+        assert state._phase == Phase.IDLE
+        # the next step enters again, stamps are kept so it finishes at once
+        assert state.step() == "exit"
+        assert len(state.stamps) == 4
+
+    def test_same_as_run(self):
+        calls = []
+        build_behaviour_tree(calls)._run()
+        stepped = []
+        root = build_behaviour_tree(stepped)
+        outcomes = [root.step() for i in range(5)]
+        # one execute per step, the last one also finishes the whole tree
+        assert outcomes == [None] * 4 + ["exit"]
+        assert stepped == calls
+
+    def test_tick(self):
+        sm = build_stepping_machine("sm", 4)
+        assert sm.tick(5) is None
+        assert len(sm.states["b"].states["b1"].stamps) == 1
+        assert sm.tick(100) == "exit"
+        assert len(sm.states["c"].stamps) == 4
+
+    def test_many_machines(self):
+        threads = threading.active_count()
+        machines = [build_stepping_machine("m%d" % i, 3, nested=i % 2 == 0) for i in range(2000)]
+        frames = 0
+        outcomes = [None] * len(machines)
+        while None in outcomes:
+            for i, sm in enumerate(machines):
+                if outcomes[i] is None:
+                    outcomes[i] = sm.step()
+            frames += 1
+        # every machine needs the same number of steps, whatever its nesting
+        assert frames == 9
+        assert outcomes == ["exit"] * len(machines)
+        assert threading.active_count() == threads
+
+    def test_pause_and_preempt(self):
+        sm = build_stepping_machine("sm", 1 << 62, nested=False)
+        state = sm.states["a"]
+        sm.tick(3)
+        sm.pause(True)
+        assert state.paused == 1
+        sm.tick(3)
+        assert len(state.stamps) == 3
+        sm.pause(False)
+        sm.tick(2)
+        assert len(state.stamps) == 5
+        assert sm.preempt(wait=False)
+        assert sm.step() == "__preempted__"
+        assert len(state.stamps) == 5
+        # a new run starts after a stop
+        sm.step()
+        assert len(state.stamps) == 6
+
+    def test_restart_after_preempt(self):
+        class CountingState(SteppingState):
+            def begin(self, data=None):
+                self.begins = getattr(self, "begins", 0) + 1
+                self.executes = 0
+
+            def execute(self, data=None):
+                self.executes += 1
+                return SteppingState.execute(self, data)
+
+        sm = StateMachine("sm", ["finished", "__timeout__"])
+        inner = StateMachine("inner", ["finished", "__timeout__"])
+        state = CountingState("spin", ["finished"])
+        state.set_timeout(0.05)
+        inner.add_state(state, {}, initial=True)
+        sm.add_state(inner, {}, initial=True)
+        sm.tick(3)
+        assert state.executes == 3
+        assert sm.preempt(wait=False)
+        assert sm.step() == "__preempted__"
+        # the whole active path has left, its timer included
+        assert inner._phase == Phase.IDLE and state._phase == Phase.IDLE
+        assert state._timer is None
+        time.sleep(0.1)
+        assert not state.is_timed_out()
+        assert sm.step() is None
+        assert state.begins == 2
+        assert state.executes == 1
+
+    def test_not_steppable(self):
+        states = [
+            TestAsyncState("async", ["exit"]),
+            AsyncStateMachine("async_sm", ["exit"]),
+            ProcessState("process", SummingState, ["exit"], args=("test1", ["exit"], 1)),
+            ConcurrentState("concurrent", ["exit"]),
+        ]
+        for state in states:
+            with self.assertRaises(TypeError):
+                state.step()
+            with self.assertRaises(TypeError):
+                state.tick(3)
+            assert state._phase == Phase.IDLE
+        # inside a stepped machine one step runs them to the end
+        sm = StateMachine("sm", ["exit"])
+        sm.add_state(states[0], {}, initial=True)
+        assert sm.step() == "exit"
+        assert states[0].test_execute == 3
+
+    def test_allocation_free(self):
+        machines = [state_machine_bench.build_ring(5) for i in range(50)]
+        tracemalloc.start()
+        try:
+            # the default transition log keeps allocating until its ring buffer has wrapped once
+            for i in range(100):
+                for sm in machines:
+                    sm.tick(5)
+            before = tracemalloc.get_traced_memory()[0]
+            for i in range(20):
+                for sm in machines:
+                    sm.tick(5)
+            assert tracemalloc.get_traced_memory()[0] - before < 1024
+        finally:
+            tracemalloc.stop()
+
+
 if __name__ == "__main__":
     unittest.main()